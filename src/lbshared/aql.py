@@ -0,0 +1,173 @@
+"""Convenience functions for running AQL queries against ArangoDB. The
+arango_crud library only exposes a key/value interface, which costs one
+request per document. This reuses the same configuration (cluster selection,
+authorization, and back-off) to reach the cursor API for the cases where a
+single query can replace many document requests.
+
+Documents written through arango_crud are stored as an object with the keys
+`_key`, `expires_at`, and `value`, where `value` is the body that arango_crud
+exposes. The helpers in this module follow that layout.
+
+Unlike arango_crud, which opens a new HTTP connection for every request, the
+requests made here go through a per-thread requests Session so that
+connections to the coordinators are kept alive between queries.
+"""
+import os
+import threading
+import time
+import requests
+
+_SESSIONS = threading.local()
+"""Holds `pid` and `session`, the requests Session for the current thread.
+Sockets can't be shared with a forked process, so a new process gets a new
+session. See _session."""
+
+
+def execute(db, query, bind_vars=None, batch_size=None):
+    """Run the given AQL query within the given database and return every
+    result, following the cursor if the results span multiple batches.
+
+    Example:
+
+    ```py
+    import lbshared.aql as aql
+    from lbshared.lazy_integrations import LazyIntegrations as LazyItgs
+
+    with LazyItgs() as itgs:
+        keys = aql.execute(
+            itgs.kvs_db,
+            'FOR d IN @@collection LIMIT @limit RETURN d._key',
+            {'@collection': 'delayed_queue', 'limit': 5}
+        )
+    ```
+
+    Arguments:
+    - `db (arango_crud.database.Database)`: The database to run the query in
+    - `query (str)`: The AQL query to run.
+    - `bind_vars (dict, None)`: The bind parameters for the query. Collection
+        bind parameters are prefixed with `@` as usual for AQL.
+    - `batch_size (int, None)`: The maximum number of results per round-trip,
+        or None for the server default.
+
+    Raises:
+    - `requests.exceptions.HTTPError`: If the query is rejected, for example
+        with a 404 if it references a collection which does not exist.
+
+    Returns:
+    - `results (list)`: Every result from the query, in order.
+    """
+    body = {'query': query}
+    if bind_vars:
+        body['bindVars'] = bind_vars
+    if batch_size is not None:
+        body['batchSize'] = batch_size
+
+    resp = _request('post', db.config, f'/_db/{db.name}/_api/cursor', json=body)
+    resp.raise_for_status()
+    page = resp.json()
+    results = page['result']
+
+    while page.get('hasMore'):
+        resp = _request('put', db.config, f'/_db/{db.name}/_api/cursor/{page["id"]}')
+        resp.raise_for_status()
+        page = resp.json()
+        results.extend(page['result'])
+
+    return results
+
+
+def read_docs(coll, keys):
+    """Fetch the bodies of all the documents with the given keys within the
+    given collection using a single query. This is equivalent to calling
+    `coll.read_doc` on each key, without a round-trip per key.
+
+    Arguments:
+    - `coll (arango_crud.collection.Collection)`: The collection to read from
+    - `keys (list[str])`: The keys of the documents to read
+
+    Raises:
+    - `requests.exceptions.HTTPError`: If the read fails, for example with a
+        404 if the collection does not exist.
+
+    Returns:
+    - `bodies (dict[str, any])`: The body of each document that exists, keyed
+        by its key. Keys for documents which do not exist are omitted.
+    """
+    if not keys:
+        return {}
+
+    rows = execute(
+        coll.database,
+        'FOR d IN @@collection FILTER d._key IN @keys RETURN [d._key, d.value]',
+        {'@collection': coll.name, 'keys': list(keys)},
+        batch_size=len(keys)
+    )
+    return dict(rows)
+
+
+def _request(method, config, partial_url, **kwargs):
+    """Performs the given request against the cluster in the given config,
+    the same way that arango_crud does: a coordinator is selected for each
+    attempt, errors and 5xx responses are retried according to the config's
+    back-off strategy, and a 401 is retried once if the auth can be
+    recovered. The difference is that the request goes through the session
+    for this thread.
+
+    Arguments:
+    - `method (str)`: The http verb, e.g., 'post'
+    - `config (arango_crud.config.Config)`: The arango configuration
+    - `partial_url (str)`: The path for the request, starting with a slash
+    - `kwargs (dict)`: Passed through to the session
+
+    Raises:
+    - `requests.exceptions.RequestException`: If every attempt failed
+
+    Returns:
+    - `response (requests.Response)`: The first response which was not
+        retried. Note this may be an error response.
+    """
+    headers = {}
+    kwargs['headers'] = headers
+    kwargs.setdefault('timeout', config.timeout_seconds)
+    if config.verify is not None:
+        kwargs.setdefault('verify', config.verify)
+    config.auth.authorize(headers, config)
+
+    session = _session()
+    request_number = 1
+    reattempted_auth = False
+    while True:
+        url = config.cluster.select_next_url().rstrip('/') + partial_url
+
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            pass
+
+        if response is not None and response.status_code < 500:
+            if (response.status_code == 401
+                    and not reattempted_auth
+                    and config.auth.try_recover_auth_failure()):
+                config.auth.authorize(headers, config)
+                reattempted_auth = True
+            else:
+                return response
+
+        delay = config.back_off.get_back_off(request_number)
+        if delay is None:
+            raise requests.exceptions.RequestException(
+                f'Max retries ({request_number - 1}) exceeded for endpoint {partial_url}'
+            )
+        request_number += 1
+        time.sleep(delay)
+
+
+def _session():
+    """Get the requests Session for the current thread, initializing it if
+    necessary."""
+    pid = os.getpid()
+    if getattr(_SESSIONS, 'pid', None) != pid:
+        _SESSIONS.session = requests.Session()
+        _SESSIONS.pid = pid
+    return _SESSIONS.session
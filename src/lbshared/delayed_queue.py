@@ -4,9 +4,15 @@ This will initialize the arango collection if it does not exist with a TTL of
 365 days.
 """
 import uuid
+import os
+import threading
+import weakref
+from concurrent import futures
 import requests.exceptions
-from pypika import PostgreSQLQuery as Query, Table, Parameter, Order
+from pypika import PostgreSQLQuery as Query, Table, Parameter, Order, Tuple
 from lbshared.signal_helper import delay_signals
+from lbshared.lazy_integrations import LazyIntegrations
+import lbshared.aql as aql
 from datetime import datetime
 from lblogging import Level
 
@@ -15,6 +21,112 @@ QUEUE_TYPES = {
 }
 """Maps from pretty names to the corresponding unique queue type value."""
 
+_EXECUTOR_LOCK = threading.Lock()
+_EXECUTOR = None
+"""The (pid, executor) pair used for background work: postgres queries which
+run while we make the corresponding arango request, and the metadata deletes
+in consume_events. Arango requests using the caller's integrations have to
+stay on the calling thread since arango_crud binds authorization state to the
+thread which first used it, whereas a psycopg2 connection may be used from any
+thread as long as it's not used from two at once. Work which doesn't use the
+caller's integrations may do anything."""
+
+_UUID_POOL_LOCK = threading.Lock()
+_UUID_POOL = []
+"""Version 4 uuids which have been generated but not yet handed out. These are
+generated in batches to amortize the cost of reading from the system random
+source. See _next_uuid4."""
+
+_DEL_QUEUE = Table('delayed_queue')
+
+_INSERT_SQL = (
+    Query.into(_DEL_QUEUE)
+    .columns(_DEL_QUEUE.uuid, _DEL_QUEUE.queue_type, _DEL_QUEUE.event_at)
+    .insert(*[Parameter('%s') for _ in range(3)])
+    .get_sql()
+)
+"""Inserts a single event; takes the uuid, queue type, and event time"""
+
+_DELETE_SQL = (
+    Query.from_(_DEL_QUEUE)
+    .delete()
+    .where(_DEL_QUEUE.uuid == Parameter('%s'))
+    .get_sql()
+)
+"""Deletes a single event by uuid"""
+
+_DELETE_RETURNING_SQL = (
+    Query.from_(_DEL_QUEUE)
+    .delete()
+    .where(_DEL_QUEUE.uuid == Parameter('%s'))
+    .returning(_DEL_QUEUE.id)
+    .get_sql()
+)
+"""Deletes a single event by uuid, returning its id if it existed"""
+
+
+def _index_statement(order, with_before, with_after, with_cursor):
+    """Returns the (name, prepare sql, execute sql) for the select used by
+    index_events with the given options. Ties on the event time are broken by
+    the uuid so that (event_at, uuid) is a stable cursor for pagination. The
+    cursor selects the rows which come after it in the requested order, i.e.,
+    earlier rows when descending."""
+    name = (
+        f'lbshared_dq_index_{order}_'
+        f'{int(with_before)}{int(with_after)}{int(with_cursor)}'
+    )
+    num_args = 2 + int(with_before) + int(with_after) + 2 * int(with_cursor)
+    params = [Parameter(f'${i}') for i in range(1, num_args + 1)]
+
+    query = (
+        Query.from_(_DEL_QUEUE)
+        .select(_DEL_QUEUE.uuid, _DEL_QUEUE.event_at)
+        .where(_DEL_QUEUE.queue_type == params.pop(0))
+    )
+    if with_before:
+        query = query.where(_DEL_QUEUE.event_at < params.pop(0))
+    if with_after:
+        query = query.where(_DEL_QUEUE.event_at > params.pop(0))
+    if with_cursor:
+        cursor_cols = Tuple(_DEL_QUEUE.event_at, _DEL_QUEUE.uuid)
+        cursor_vals = Tuple(params.pop(0), params.pop(0))
+        if order == 'desc':
+            query = query.where(cursor_cols < cursor_vals)
+        else:
+            query = query.where(cursor_cols > cursor_vals)
+    query = (
+        query
+        .orderby(_DEL_QUEUE.event_at, _DEL_QUEUE.uuid, order=getattr(Order, order))
+        .limit(params.pop(0))
+    )
+    return (
+        name,
+        f'PREPARE {name} AS {query.get_sql()}',
+        f'EXECUTE {name} ({",".join(["%s"] * num_args)})'
+    )
+
+
+_INDEX_STATEMENTS = dict(
+    (key, _index_statement(*key))
+    for key in (
+        (order, with_before, with_after, with_cursor)
+        for order in ('asc', 'desc')
+        for with_before in (False, True)
+        for with_after in (False, True)
+        for with_cursor in (False, True)
+    )
+)
+"""Maps from (order, with_before, with_after, with_cursor) to the prepared
+statement used by index_events. Takes the queue type, then the before time,
+after time, and cursor event time and uuid if they are included, then the
+limit."""
+
+_PREPARED = weakref.WeakKeyDictionary()
+"""Maps from psycopg2 connections to the set of statement names which have
+already been prepared on them. Prepared statements last for the lifetime of
+the session and are not undone by rolling back, so this only needs to be
+forgotten when the connection goes away."""
+
 
 def store_event(itgs, queue_type, event_at, event, commit=False):
     """Store that the given event should occur at the given time with the
@@ -54,23 +166,37 @@ def store_event(itgs, queue_type, event_at, event, commit=False):
     Returns:
     - event_uuid (str): The uuid assigned to the event
     """
-    event_uuid = str(uuid.uuid4())
-
+    event_uuid = str(_next_uuid4())
+    cursor = itgs.write_cursor
     coll = itgs.kvs_db.collection('delayed_queue')
-    try:
-        coll.create_or_overwrite_doc(event_uuid, event)
-    except requests.exceptions.HTTPError:
-        coll.create_if_not_exists(ttl=31622400)
-        coll.create_or_overwrite_doc(event_uuid, event)
-
-    del_queue = Table('delayed_queue')
-    itgs.write_cursor.execute(
-        Query.into(del_queue)
-        .columns(del_queue.uuid, del_queue.queue_type, del_queue.event_at)
-        .insert(*[Parameter('%s') for _ in range(3)])
-        .get_sql(),
-        (event_uuid, queue_type, event_at)
+
+    # The insert and the metadata write are independent, so we only wait for
+    # the slower of them
+    future = _executor().submit(
+        cursor.execute, _INSERT_SQL, (event_uuid, queue_type, event_at)
     )
+    stored = False
+    try:
+        try:
+            coll.create_or_overwrite_doc(event_uuid, event)
+        except requests.exceptions.HTTPError:
+            coll.create_if_not_exists(ttl=31622400)
+            coll.create_or_overwrite_doc(event_uuid, event)
+        stored = True
+    finally:
+        # Never leave while the cursor may still be in use on the worker
+        _join(future)
+        if not stored and future.exception() is None:
+            # An event without its metadata is an integrity failure, so undo
+            # just our insert rather than the caller's whole transaction
+            cursor.execute(_DELETE_SQL, (event_uuid,))
+
+    try:
+        future.result()
+    except:  # noqa
+        coll.force_delete_doc(event_uuid)
+        raise
+
     if commit:
         itgs.write_conn.commit()
     return event_uuid
@@ -78,10 +204,11 @@ def store_event(itgs, queue_type, event_at, event, commit=False):
 
 def index_events(
         itgs, queue_type, limit, before_time=None,
-        after_time=None, order='asc', integrity_failures='include'):
+        after_time=None, order='asc', integrity_failures='include',
+        cursor=None):
     """Get the next up to limit events from the given queue, ordered from oldest
     event times (i.e., most in the past) to newest event times (i.e., most in
-    the future).
+    the future). Events with the same event time are ordered by their uuid.
 
     This will include the stored event details on each event. The nature of this
     storage technique is integrity errors wherein the event is in the queue but
@@ -117,7 +244,7 @@ def index_events(
     - `before_time (datetime, None)`: If specified events which are before a
         given date are ignored. Useful when you want past-due events.
     - `after_time (datetime, None)`: If specified events which have an event
-        time earlier than this point are not considered. Useful for pagination.
+        time earlier than this point are not considered.
     - `order (str)`: The order that results are returned in. Either 'asc' for
         oldest to newest or 'desc' for newest to oldest.
     - `integrity_failures (str)`: How to handle events whose event information
@@ -129,61 +256,35 @@ def index_events(
             results will be returned than requested, but this will resolve
             itself once all the integrity failures have been handled. This
             should be used if no additional cleanup needs to be performed.
+    - `cursor (tuple[datetime, str], None)`: If specified, the event time and
+        uuid of an event; only events which come after it in the requested
+        order are returned. For 'asc' these are the later events, and for
+        'desc' the earlier ones. This applies on top of `before_time` and
+        `after_time`. For pagination, pass the time and uuid of the last event
+        on the previous page; this will neither skip nor repeat events which
+        share an event time.
 
     Returns:
     - `events (enumerable[tuple])`: Up to limit events from the queue, where
         each event is returned as a tuple of 3 items - the event uuid,
         the event time, and the event metadata that was stored.
     """
-    del_queue = Table('delayed_queue')
-    query = (
-        Query.from_(del_queue)
-        .select(del_queue.uuid, del_queue.event_at)
-        .where(del_queue.queue_type == Parameter('%s'))
-        .orderby(del_queue.event_at, order=getattr(Order, order))
-        .limit(limit)
+    statement = _INDEX_STATEMENTS.get(
+        (order, before_time is not None, after_time is not None, cursor is not None)
     )
-    args = [queue_type]
-    if before_time is not None:
-        query = query.where(del_queue.event_at < Parameter('%s'))
-        args.append(before_time)
-
-    if after_time is not None:
-        query = query.where(del_queue.event_at > Parameter('%s'))
-        args.append(after_time)
+    if statement is None:
+        raise Exception(f'bad order: {order}')
 
-    itgs.read_cursor.execute(
-        query.get_sql(),
-        args
+    _execute_prepared(
+        itgs.read_conn, itgs.read_cursor, statement,
+        _index_args(queue_type, limit, before_time, after_time, cursor)
     )
     unaugmented = itgs.read_cursor.fetchall()
+    if not unaugmented:
+        return []
 
-    result = []
-    coll = itgs.kvs_db.collection('delayed_queue')
-    commit_required = False
-    for (ev_uuid, ev_at) in unaugmented:
-        event = coll.read_doc(ev_uuid)
-        if event is None:
-            if integrity_failures == 'include':
-                result.append((ev_uuid, ev_at, None))
-            elif integrity_failures == 'delete_and_commit':
-                itgs.write_cursor.execute(
-                    Query.from_(del_queue)
-                    .delete()
-                    .where(del_queue.uuid == Parameter('%s'))
-                    .get_sql(),
-                    (ev_uuid,)
-                )
-                commit_required = True
-            else:
-                raise Exception(f'bad integrity failure technique: {integrity_failures}')
-        else:
-            result.append((ev_uuid, ev_at, event))
-
-    if commit_required:
-        itgs.write_conn.commit()
-
-    return result
+    events = _read_events(itgs, [ev_uuid for (ev_uuid, _) in unaugmented])
+    return _augment_events(itgs, unaugmented, events, integrity_failures)
 
 
 def delete_event(itgs, event_uuid, commit=False):
@@ -213,20 +314,10 @@ def delete_event(itgs, event_uuid, commit=False):
     - `success (bool)`: True if the event was in the database, false if it was
         not.
     """
-    del_queue = Table('delayed_queue')
-    itgs.write_cursor.execute(
-        Query.from_(del_queue)
-        .delete()
-        .where(del_queue.uuid == Parameter('%s'))
-        .returning(del_queue.id)
-        .get_sql(),
-        (event_uuid,)
-    )
-    success = itgs.write_cursor.fetchone() is not None
-
-    if commit:
-        itgs.write_conn.commit()
-
+    # The metadata must outlive the queue row; if the delete or commit failed
+    # after the metadata was gone, the event would look like an integrity
+    # failure and be discarded without ever being handled
+    success = _delete_from_queue(itgs, event_uuid, commit)
     itgs.kvs_db.collection('delayed_queue').force_delete_doc(event_uuid)
     return success
 
@@ -253,6 +344,11 @@ def consume_events(itgs, queue_type, limit, handler, rollback):
     WARNING: Integrity failures are handled as if by `delete_and_commit`. This
     is a soft requirement for this type of consumer to behave properly.
 
+    The metadata of each event is deleted in the background while the handler
+    runs, after the event has been deleted from the queue and committed. Those
+    deletes are all finished before this returns, and if any of them failed
+    the error is raised once every event has been handled.
+
     Arguments:
     - `itgs (LazyIntegrations)`: The lazy integrations to use for connecting
         to third-party services.
@@ -283,21 +379,195 @@ def consume_events(itgs, queue_type, limit, handler, rollback):
         integrity_failures='delete_and_commit'
     )
 
-    for (ev_uuid, ev_at, ev) in past_due_events:
-        if not delete_event(itgs, ev_uuid, commit=True):
-            # Another consumer already handled this event
-            continue
-
-        with delay_signals(itgs):
-            context = {}
-            try:
-                handler(ev_uuid, ev_at, ev, context)
-            except:  # noqa
-                itgs.logger.exception(
-                    Level.WARN,
-                    'An unexpected error occurred processing {}',
-                    ev_uuid
+    # Once the delete from the queue is committed nothing needs the metadata
+    # anymore, so it's deleted in the background while the event is handled
+    forgetting = []
+    try:
+        for (ev_uuid, ev_at, ev) in past_due_events:
+            if not _delete_from_queue(itgs, ev_uuid, True):
+                # Another consumer already handled this event
+                continue
+
+            forgetting.append(_executor().submit(_forget_event, ev_uuid))
+            with delay_signals(itgs):
+                context = {}
+                try:
+                    handler(ev_uuid, ev_at, ev, context)
+                except:  # noqa
+                    itgs.logger.exception(
+                        Level.WARN,
+                        'An unexpected error occurred processing {}',
+                        ev_uuid
+                    )
+                    rollback(ev_uuid, ev_at, ev, context)
+                    store_event(itgs, queue_type, ev_at, ev, commit=True)
+                    raise
+    finally:
+        futures.wait(forgetting)
+
+    for future in forgetting:
+        future.result()
+
+
+def _index_args(queue_type, limit, before_time, after_time, cursor):
+    """Get the arguments to the prepared statement from _INDEX_STATEMENTS
+    for the given index_events arguments"""
+    args = [queue_type]
+    if before_time is not None:
+        args.append(before_time)
+
+    if after_time is not None:
+        args.append(after_time)
+
+    if cursor is not None:
+        args.extend(cursor)
+
+    args.append(limit)
+    return args
+
+
+def _read_events(itgs, event_uuids):
+    """Reads the metadata of the events with the given uuids in one request.
+    Returns a dict from uuids to metadata, which doesn't contain the events
+    whose metadata has been lost."""
+    coll = itgs.kvs_db.collection('delayed_queue')
+    try:
+        return aql.read_docs(coll, event_uuids)
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        # The collection doesn't exist, so every event has lost its metadata
+        return {}
+
+
+def _augment_events(itgs, unaugmented, events, integrity_failures):
+    """Pairs each (uuid, event time) row from the queue with its metadata from
+    events, handling those whose metadata has been lost as described by
+    integrity_failures in index_events. Returns the index_events result."""
+    result = []
+    lost_uuids = []
+    for (ev_uuid, ev_at) in unaugmented:
+        event = events.get(ev_uuid)
+        if event is None:
+            if integrity_failures == 'include':
+                result.append((ev_uuid, ev_at, None))
+            elif integrity_failures == 'delete_and_commit':
+                lost_uuids.append(ev_uuid)
+            else:
+                raise Exception(f'bad integrity failure technique: {integrity_failures}')
+        else:
+            result.append((ev_uuid, ev_at, event))
+
+    if lost_uuids:
+        itgs.write_cursor.execute(
+            Query.from_(_DEL_QUEUE)
+            .delete()
+            .where(_DEL_QUEUE.uuid.isin([Parameter('%s') for _ in lost_uuids]))
+            .get_sql(),
+            lost_uuids
+        )
+        itgs.write_conn.commit()
+
+    return result
+
+
+def _delete_from_queue(itgs, event_uuid, commit):
+    """Deletes the event with the given uuid from the queue, leaving its
+    metadata alone, and returns True if it was in the queue. See
+    `delete_event`."""
+    itgs.write_cursor.execute(_DELETE_RETURNING_SQL, (event_uuid,))
+    success = itgs.write_cursor.fetchone() is not None
+
+    if commit:
+        itgs.write_conn.commit()
+    return success
+
+
+def _forget_event(event_uuid):
+    """Deletes the metadata of the event with the given uuid. This opens its
+    own integrations so that it can run on any thread."""
+    with LazyIntegrations() as itgs:
+        itgs.kvs_db.collection('delayed_queue').force_delete_doc(event_uuid)
+
+
+def _execute_prepared(conn, cursor, statement, args):
+    """Execute the given prepared statement, preparing it on the connection
+    first if this is the first time it's been used on that connection, so
+    that postgres only has to parse and plan it once per session.
+
+    Arguments:
+    - `conn (psycopg2.connection)`: The connection the cursor belongs to
+    - `cursor (psycopg2.cursor)`: The cursor to execute the statement on
+    - `statement (tuple)`: The (name, prepare sql, execute sql) triplet
+    - `args (list)`: The arguments to the statement
+    """
+    name, prepare_sql, execute_sql = statement
+    prepared = _PREPARED.get(conn)
+    if prepared is None:
+        prepared = set()
+        _PREPARED[conn] = prepared
+
+    if name not in prepared:
+        cursor.execute(prepare_sql)
+        prepared.add(name)
+
+    cursor.execute(execute_sql, args)
+
+
+def _next_uuid4():
+    """Equivalent to uuid.uuid4(), except the random bytes are read from the
+    operating system enough for 256 uuids at a time."""
+    with _UUID_POOL_LOCK:
+        if not _UUID_POOL:
+            raw = os.urandom(16 * 256)
+            _UUID_POOL.extend(
+                uuid.UUID(bytes=raw[i:i + 16], version=4)
+                for i in range(0, len(raw), 16)
+            )
+        return _UUID_POOL.pop()
+
+
+def _reset_uuid_pool():
+    """A forked process must not hand out the same uuids as its parent, and
+    can't rely on the state of a lock which another thread may have held
+    during the fork."""
+    global _UUID_POOL_LOCK, _UUID_POOL
+    _UUID_POOL_LOCK = threading.Lock()
+    _UUID_POOL = []
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_uuid_pool)
+
+
+def _join(future):
+    """Waits for the given future to finish. If the wait is interrupted, for
+    example by a KeyboardInterrupt, it keeps waiting and re-raises the
+    interruption once the future is done. Until then the worker may still be
+    using the caller's cursor, and the connection must not be returned to the
+    pool or used by anything else."""
+    interruption = None
+    while not future.done():
+        try:
+            futures.wait((future,))
+        except BaseException as exc:  # noqa
+            interruption = exc
+    if interruption is not None:
+        raise interruption
+
+
+def _executor():
+    """Get the thread pool for background postgres queries, initializing it
+    if necessary. Worker threads do not survive a fork, so a forked process
+    gets its own pool."""
+    global _EXECUTOR
+    pid = os.getpid()
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None or _EXECUTOR[0] != pid:
+            _EXECUTOR = (
+                pid,
+                futures.ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix='lbshared-delayed-queue'
                 )
-                rollback(ev_uuid, ev_at, ev, context)
-                store_event(itgs, queue_type, ev_at, ev, commit=True)
-                raise
+            )
+        return _EXECUTOR[1]
@@ -28,11 +28,38 @@ reconnect a little bit).
     time while in an important transaction.
 """
 import psycopg2
+import psycopg2.pool
 import pika
 from pymemcache.client import base as membase
 import os
+import threading
+import time
+import weakref
 from arango_crud import env_config
 
+_DATABASE_POOL_LOCK = threading.Lock()
+_DATABASE_POOL = None
+"""The (pid, pool) pair for the process-wide database connection pool. See
+database_pool()."""
+
+_FORKED_DATABASE_POOLS = []
+"""Pools which were inherited from a parent process. Their connections belong
+to the parent, and closing them here (including by garbage collecting them)
+would terminate the parent's sessions, so they are kept alive but unused."""
+
+_AMQP_PARAMETERS = None
+"""The pika connection parameters built from the environment the first time
+amqp() is called. These are resolved lazily so that services which never
+connect to the AMQP server don't need its environment variables."""
+
+_SHARED_AMQP = threading.local()
+"""Holds `pid`, `connection`, and `channel` for the AMQP connection shared by
+everything on the current thread. See shared_amqp()."""
+
+_MEMCACHED_ADDRESS = None
+"""The (host, port) of the memcached server, resolved from the environment the
+first time cache() is called."""
+
 
 def database():
     """
@@ -43,21 +70,168 @@ def database():
     return psycopg2.connect('')
 
 
+class RecyclingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A thread-safe connection pool which closes connections once they have been
+    open for a given amount of time, rather than keeping them forever. This
+    bounds how long a backend can accumulate memory and means connections
+    eventually move to new servers when the database is failed over.
+
+    Idle connections are handed out most-recently-returned first, which is
+    how the psycopg2 pools already behave. This keeps the busiest connections
+    warm (e.g., with prepared statements and cached plans) while the rest go
+    idle.
+
+    The psycopg2 pools use minconn both for how many connections are opened
+    up front and for how many idle connections are kept, closing any
+    connection which is returned beyond that. Here those are separate, so
+    that a pool can start small but still keep every connection open through
+    bursts of concurrent use instead of reconnecting each time.
+
+    @param [int] minconn The number of connections to open immediately
+    @param [int] maxconn The maximum number of connections to check out
+    @param [float] recycle_seconds How long a connection may be open before
+        it is closed instead of being reused.
+    @param [int, None] max_idle The number of idle connections to keep, or
+        None to keep up to maxconn.
+    """
+    def __init__(self, minconn, maxconn, recycle_seconds, *args, max_idle=None, **kwargs):
+        self.recycle_seconds = recycle_seconds
+        self._opened_at = weakref.WeakKeyDictionary()
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # _putconn keeps returned connections while fewer than minconn are idle
+        self.minconn = self.maxconn if max_idle is None else int(max_idle)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        self._opened_at[conn] = time.monotonic()
+        return conn
+
+    def _getconn(self, key=None):
+        if not self.closed:
+            for conn in [c for c in self._pool if self._expired(c)]:
+                self._pool.remove(conn)
+                conn.close()
+        return super()._getconn(key)
+
+    def _putconn(self, conn, key=None, close=False):
+        super()._putconn(conn, key, close or self._expired(conn))
+
+    def _expired(self, conn):
+        opened_at = self._opened_at.get(conn)
+        return opened_at is not None and time.monotonic() - opened_at > self.recycle_seconds
+
+
+def database_pool():
+    """
+    Fetches the process-wide pool of database connections, initializing it if
+    necessary. Connections are checked out with getconn() and must be returned
+    with putconn(), which rolls back any open transaction. This is much faster
+    than opening a new connection for each use, since it avoids the TCP, TLS,
+    and authentication handshakes.
+
+    The pool is configured with the environment variables PG_POOL_MIN, the
+    number of connections opened up front (default 1), PG_POOL_MAX, the
+    maximum number of connections checked out at once (default 10), and
+    PG_POOL_MAX_IDLE, the number of idle connections which are kept open
+    (default PG_POOL_MAX, so connections are reused however many are in use
+    at once). When the pool is exhausted getconn() raises
+    psycopg2.pool.PoolError. Connections are closed rather than reused once
+    they are older than PG_POOL_RECYCLE_SECONDS (default 3600).
+
+    A forked process gets its own pool.
+
+    @return [RecyclingConnectionPool] The pool of write/read database
+        connections.
+    """
+    global _DATABASE_POOL
+    pid = os.getpid()
+    with _DATABASE_POOL_LOCK:
+        if _DATABASE_POOL is None or _DATABASE_POOL[0] != pid:
+            if _DATABASE_POOL is not None:
+                _FORKED_DATABASE_POOLS.append(_DATABASE_POOL[1])
+            max_conn = int(os.environ.get('PG_POOL_MAX', '10'))
+            _DATABASE_POOL = (
+                pid,
+                RecyclingConnectionPool(
+                    int(os.environ.get('PG_POOL_MIN', '1')),
+                    max_conn,
+                    float(os.environ.get('PG_POOL_RECYCLE_SECONDS', '3600')),
+                    '',
+                    max_idle=int(os.environ.get('PG_POOL_MAX_IDLE', str(max_conn)))
+                )
+            )
+        return _DATABASE_POOL[1]
+
+
 def amqp():
     """
     Opens a new connection to the AMQP server.
 
     @return BlockingConnection A pika blocking connection to the AMQP server
     """
-    parameters = pika.ConnectionParameters(
-        os.environ['AMQP_HOST'],
-        int(os.environ['AMQP_PORT']),
-        os.environ['AMQP_VHOST'],
-        pika.PlainCredentials(
-            os.environ['AMQP_USERNAME'], os.environ['AMQP_PASSWORD']
+    global _AMQP_PARAMETERS
+    if _AMQP_PARAMETERS is None:
+        _AMQP_PARAMETERS = pika.ConnectionParameters(
+            os.environ['AMQP_HOST'],
+            int(os.environ['AMQP_PORT']),
+            os.environ['AMQP_VHOST'],
+            pika.PlainCredentials(
+                os.environ['AMQP_USERNAME'], os.environ['AMQP_PASSWORD']
+            )
         )
-    )
-    return pika.BlockingConnection(parameters)
+    return pika.BlockingConnection(_AMQP_PARAMETERS)
+
+
+def shared_amqp():
+    """
+    Fetches the AMQP connection and channel shared by the current thread,
+    opening them if this is the first use in this thread or if they have been
+    closed. The channel is in publisher-confirm mode. Reusing these saves the
+    connection handshake, in addition to opening the channel and enabling
+    confirms, which are each a round-trip to the server.
+
+    pika connections may not be shared between threads, hence this is per
+    thread. The channel is shared by everything on this thread which calls
+    this, so anything which uses it for more than publishing must close it
+    afterward. Otherwise whatever it left on the channel, such as consumers,
+    deliveries which haven't been acked, a prefetch limit, or exclusive or
+    auto-delete queues, would carry over to the next caller. Closing the
+    channel requeues its unacked deliveries, and the next call opens a new
+    one. LazyIntegrations does this on exit, see LazyIntegrations.channel.
+    The connection must not be closed by the caller unless it is unusable.
+
+    @return [BlockingConnection, BlockingChannel] The shared connection and
+        channel for this thread.
+    """
+    pid = os.getpid()
+    connection = None
+    channel = None
+    if getattr(_SHARED_AMQP, 'pid', None) == pid:
+        connection = _SHARED_AMQP.connection
+        channel = _SHARED_AMQP.channel
+
+    if connection is not None and connection.is_open:
+        try:
+            # services heartbeats and surfaces a dropped connection now
+            # rather than part way through the caller's work
+            connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError:
+            connection = None
+    else:
+        connection = None
+
+    if connection is None:
+        connection = amqp()
+        channel = None
+        _SHARED_AMQP.pid = pid
+        _SHARED_AMQP.connection = connection
+
+    if channel is None or not channel.is_open:
+        channel = connection.channel()
+        channel.confirm_delivery()
+    _SHARED_AMQP.channel = channel
+    return (connection, channel)
 
 
 def cache():
@@ -66,9 +240,12 @@ def cache():
 
     @return [Client] The memcached client
     """
-    memcache_host = os.environ['MEMCACHED_HOST']
-    memcache_port = int(os.environ['MEMCACHED_PORT'])
-    return membase.Client((memcache_host, memcache_port))
+    global _MEMCACHED_ADDRESS
+    if _MEMCACHED_ADDRESS is None:
+        _MEMCACHED_ADDRESS = (
+            os.environ['MEMCACHED_HOST'], int(os.environ['MEMCACHED_PORT'])
+        )
+    return membase.Client(_MEMCACHED_ADDRESS)
 
 
 def kvstore():
@@ -19,10 +19,21 @@ used.
 """
 from . import integrations as itgs
 from lblogging import Logger
+import psycopg2
+import psycopg2.pool
 import os
+import threading
 from arango_crud.config import Config
 from arango_crud.database import Database
 
+_ARANGO = threading.local()
+"""Caches the arango configuration for the current thread, so that the JWT
+can be reused across LazyIntegrations instead of being reloaded or
+reacquired for each one. This is per-thread since arango_crud's JWT
+authorization may only be used from the thread which first used it. Has the
+attributes `pid`, `config`, and `dbs`, which maps from database names to
+database handles. See _arango_handles."""
+
 
 class LazyIntegrations:
     """Contains lazily-loaded connection properties, which are cleaned up
@@ -49,6 +60,23 @@ class LazyIntegrations:
     @param [str] logger_iden The identifier to initialize the logger with;
         typically the file and function initializing the lazy integrations.
     """
+    _TEARDOWN = (
+        ('_logger', '_close_logger'),
+        ('_conn', '_close_database'),
+        ('_amqp', '_close_amqp'),
+        ('_cache', '_close_cache'),
+    )
+    """The (attribute, method) pairs for closing the integrations we manage;
+    the method is called on exit with the type of the exception the block
+    raised, if any, if the attribute was initialized.
+
+    These are closed in this fixed order rather than the order they were first
+    used. Each is a separate connection and none of the close methods uses
+    another integration, so the order between them doesn't matter. Additional
+    cleanup can be registered by appending to `closures`, which is called with
+    the exit arguments before any of these are closed. That way a closure may
+    still use any integration, and whatever it opens is closed after it."""
+
     def __init__(self, no_read_only=False, logger_iden='lazy_integrations.py#logger'):
         self.closures = []
         self.no_read_only = no_read_only
@@ -56,6 +84,7 @@ class LazyIntegrations:
         self._logger = None
         self._conn = None
         self._cursor = None
+        self._pool = None
         self._amqp = None
         self._channel = None
         self._cache = None
@@ -75,6 +104,13 @@ class LazyIntegrations:
                 # an opportunity
                 errors.append(e)
 
+        for (attr, close) in self._TEARDOWN:
+            if getattr(self, attr) is not None:
+                try:
+                    getattr(self, close)(exc_type)
+                except Exception as e:  # noqa
+                    errors.append(e)
+
         if len(errors) == 1:
             raise errors[0]
         elif errors:
@@ -95,11 +131,6 @@ class LazyIntegrations:
             logger_conn
         )
         self._logger.prepare()
-
-        def closure(*args):
-            self._logger.connection.close()
-
-        self.closures.append(closure)
         return self._logger
 
     @property
@@ -130,47 +161,60 @@ class LazyIntegrations:
     @property
     def write_conn_and_cursor(self):
         """Returns the writable database connection alongside the cursor. The
-        connection can be used to commit."""
+        connection can be used to commit.
+
+        The connection is borrowed from the process-wide pool and returned to
+        it when this object is exited, which rolls back any uncommitted
+        transaction. If the pool is exhausted a dedicated connection is opened
+        instead, which is closed on exit."""
         if self._conn is not None:
             return (self._conn, self._cursor)
 
-        self._conn = itgs.database()
+        pool = itgs.database_pool()
+        try:
+            self._conn = pool.getconn()
+            self._pool = pool
+        except psycopg2.pool.PoolError:
+            self._conn = itgs.database()
         self._cursor = self._conn.cursor()
-
-        def closure(*args):
-            self._cursor.close()
-            self._conn.close()
-
-        self.closures.append(closure)
         return (self._conn, self._cursor)
 
     @property
     def amqp(self):
         """Get the advanced message queue pika instance, which is really
-        only necessary if you need to declare custom channels"""
+        only necessary if you need to declare custom channels. The connection
+        is shared by the current thread, so any custom channels should be
+        closed when they are no longer needed."""
         return self.amqp_and_channel[0]
 
     @property
     def channel(self):
-        """The AMQP channel to use."""
+        """The AMQP channel to use, which is in publisher-confirm mode.
+
+        This channel is shared with the other LazyIntegrations on the same
+        thread, so that they don't each have to open one. It's kept open on
+        exit only if it was used for nothing but publishing and the block did
+        not raise. Otherwise it's closed, since whatever else was done on it
+        could leak to the next user: consumers, deliveries which haven't been
+        acked, prefetch limits, exclusive or auto-delete queues, and so on.
+        Closing it requeues any unacked deliveries, and the next
+        LazyIntegrations on this thread opens a new channel.
+
+        The channel is wrapped to track how it's used, but otherwise behaves
+        just like the pika channel."""
         return self.amqp_and_channel[1]
 
     @property
     def amqp_and_channel(self):
-        """Get both the AMQP pika instance and the channel we are using"""
+        """Get both the AMQP pika instance and the channel we are using. These
+        are shared with other LazyIntegrations on the same thread. The
+        connection is kept open on exit, and the channel is kept or closed as
+        described in `channel`. See integrations.shared_amqp."""
         if self._amqp is not None:
             return (self._amqp, self._channel)
 
-        self._amqp = itgs.amqp()
-        self._channel = self._amqp.channel()
-        self._channel.confirm_delivery()
-
-        def closure(*args):
-            self._channel.close()
-            self._amqp.close()
-
-        self.closures.append(closure)
-
+        self._amqp, channel = itgs.shared_amqp()
+        self._channel = _SharedChannel(channel)
         return (self._amqp, self._channel)
 
     @property
@@ -180,11 +224,6 @@ class LazyIntegrations:
             return self._cache
 
         self._cache = itgs.cache()
-
-        def closure(*args):
-            self._cache.close()
-
-        self.closures.append(closure)
         return self._cache
 
     @property
@@ -193,7 +232,7 @@ class LazyIntegrations:
         if self._arango_conn is not None:
             return self._arango_conn
 
-        self._arango_conn = itgs.kvstore()
+        self._arango_conn = _arango_handles().config
         return self._arango_conn
 
     @property
@@ -202,5 +241,120 @@ class LazyIntegrations:
         if self._arango_db is not None:
             return self._arango_db
 
-        self._arango_db = self.kvs_conn.database(os.environ['ARANGO_DB'])
+        name = os.environ['ARANGO_DB']
+        dbs = _arango_handles().dbs
+        self._arango_db = dbs.get(name)
+        if self._arango_db is None:
+            self._arango_db = self.kvs_conn.database(name)
+            dbs[name] = self._arango_db
         return self._arango_db
+
+    def _close_logger(self, exc_type):
+        logger, self._logger = self._logger, None
+        logger.connection.close()
+
+    def _close_database(self, exc_type):
+        conn, cursor, pool = self._conn, self._cursor, self._pool
+        self._conn, self._cursor, self._pool = None, None, None
+        try:
+            cursor.close()
+        finally:
+            if pool is None:
+                conn.close()
+            else:
+                _return_to_pool(pool, conn)
+
+    def _close_amqp(self, exc_type):
+        channel = self._channel
+        self._amqp, self._channel = None, None
+        if (exc_type is not None or not channel.reusable) and channel.is_open:
+            channel.pika_channel.close()
+
+    def _close_cache(self, exc_type):
+        cache, self._cache = self._cache, None
+        cache.close()
+
+
+class _SharedChannel:
+    """Wraps the AMQP channel shared by the current thread for a single
+    LazyIntegrations, forwarding everything to the pika channel. It notes
+    whether the channel was used for anything which could leave state behind
+    on it; only publishing and checking whether it's open can't. See
+    LazyIntegrations.channel."""
+    __slots__ = ('pika_channel', 'reusable')
+
+    _STATELESS = frozenset(('basic_publish', 'is_open', 'is_closed', 'channel_number'))
+    """The attributes which can be used without making the channel unsafe for
+    the next user"""
+
+    def __init__(self, pika_channel):
+        self.pika_channel = pika_channel
+        self.reusable = True
+
+    def __getattr__(self, name):
+        if name not in self._STATELESS:
+            self.reusable = False
+        return getattr(self.pika_channel, name)
+
+
+def _arango_handles():
+    """Fetches the arango handles for the current thread, initializing them
+    if this thread hasn't used arango yet in this process."""
+    pid = os.getpid()
+    if getattr(_ARANGO, 'pid', None) != pid:
+        _ARANGO.config = itgs.kvstore()
+        _ARANGO.dbs = {}
+        _ARANGO.pid = pid
+    return _ARANGO
+
+
+def borrow_read_cursor():
+    """Borrows a database connection and a cursor on it straight from the
+    process-wide pool, without building a LazyIntegrations. This is meant for
+    hot paths which only need to run a few reads; when several integrations
+    are needed LazyIntegrations is simpler. The pair must be given back with
+    return_read_cursor.
+
+    @example
+        conn, cursor = borrow_read_cursor()
+        try:
+            cursor.execute('SELECT NOW()')
+            print(f'db now={cursor.fetchone()[0]}')
+        finally:
+            return_read_cursor(conn, cursor)
+
+    @raise psycopg2.pool.PoolError If every connection in the pool is in use
+    @return [connection, cursor] The borrowed connection and a new cursor
+    """
+    pool = itgs.database_pool()
+    conn = pool.getconn()
+    try:
+        return (conn, conn.cursor())
+    except:  # noqa
+        _return_to_pool(pool, conn)
+        raise
+
+
+def return_read_cursor(conn, cursor):
+    """Returns a connection which was borrowed with borrow_read_cursor. This
+    closes the cursor and rolls back any open transaction on the connection.
+
+    @param [connection] conn The connection from borrow_read_cursor
+    @param [cursor] cursor The cursor from borrow_read_cursor
+    """
+    try:
+        cursor.close()
+    finally:
+        _return_to_pool(itgs.database_pool(), conn)
+
+
+def _return_to_pool(pool, conn):
+    """Returns the given connection to the given pool. If the connection can't
+    be returned to a consistent state (e.g., it was lost mid-transaction) or
+    the pool has since been closed, the connection is discarded instead."""
+    try:
+        pool.putconn(conn)
+    except psycopg2.pool.PoolError:
+        conn.close()
+    except psycopg2.Error:
+        pool.putconn(conn, close=True)
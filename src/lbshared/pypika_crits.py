@@ -3,10 +3,15 @@ from pypika.terms import Criterion
 
 
 class ExistsCriterion(Criterion):
-    """https://github.com/kayak/pypika/issues/278"""
+    """https://github.com/kayak/pypika/issues/278
+
+    The rendered subquery is cached per set of rendering options, since the
+    pypika builder methods return copies rather than modifying the container.
+    """
     def __init__(self, container, alias=None):
         super(ExistsCriterion, self).__init__(alias)
         self.container = container
+        self._sql_cache = {}
 
     @property
     def tables_(self):
@@ -31,17 +36,33 @@ class ExistsCriterion(Criterion):
 
     def _get_container_sql(self, **kwargs):
         kwargs['quote_char'] = '"'
+        try:
+            key = tuple(sorted(kwargs.items()))
+            sql = self._sql_cache.get(key)
+        except TypeError:
+            # unhashable rendering options; just don't cache
+            key = None
+            sql = None
+
+        if sql is None:
+            sql = self._render_container_sql(**kwargs)
+            if key is not None:
+                self._sql_cache[key] = sql
+        return sql
+
+    def _render_container_sql(self, **kwargs):
+        container = self.container
         return ''.join((
             'SELECT',
-            self.container._from_sql(**kwargs),
+            container._from_sql(**kwargs),
             ' ' + ' '.join(
-                join.get_sql(**kwargs) for join in self.container._joins
-            ) if self.container._joins else '',
-            self.container._prewhere_sql(**kwargs) if self.container._prewheres else '',
-            self.container._where_sql(**kwargs) if self.container._wheres else '',
-            self.container._group_sql(**kwargs) if self.container._groupbys else '',
-            self.container._having_sql(**kwargs) if self.container._havings else '',
-            self.container._orderby_sql(**kwargs) if self.container._orderbys else '',
+                join.get_sql(**kwargs) for join in container._joins
+            ) if container._joins else '',
+            container._prewhere_sql(**kwargs) if container._prewheres else '',
+            container._where_sql(**kwargs) if container._wheres else '',
+            container._group_sql(**kwargs) if container._groupbys else '',
+            container._having_sql(**kwargs) if container._havings else '',
+            container._orderby_sql(**kwargs) if container._orderbys else '',
         ))
 
 
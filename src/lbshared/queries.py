@@ -2,6 +2,9 @@
 import pytypeutils as tus
 import re
 
+_NUMBERED_ARG_PATTERN = re.compile(r'\$(\d+)')
+"""The pattern for a numbered argument, where the first group is the number"""
+
 
 def convert_numbered_args(query, args):
     """Converts a query which was written using numbered args to the
@@ -49,11 +52,11 @@ def convert_numbered_args(query, args):
         return (query, tuple())
 
     result_args = []
-    pattern = r'\$(\d+)'
 
-    for match in re.finditer(pattern, query):
+    def replace(match):
         result_args.append(args[int(match.group(1)) - 1])
+        return '%s'
 
-    result_query = re.sub(pattern, '%s', query)
+    result_query = _NUMBERED_ARG_PATTERN.sub(replace, query)
 
     return (result_query, tuple(result_args))
@@ -5,9 +5,11 @@ If a users refill rate or maximum is changed, it will be applied retroactively
 since the last time they consumed a token.
 """
 from pydantic import BaseModel
+import functools
 import time
+import requests.exceptions
+import lbshared.aql as aql
 from lblogging import Level
-import math
 
 
 class Settings(BaseModel):
@@ -53,9 +55,15 @@ def consume(itgs, settings, consumer, amt) -> bool:
 
     This endpoint is concurrency-safe but not fair. That is to say, if there
     are many requests to consume the same resource we do not promise that the
-    earlier requests will get the tokens. Furthermore if there is too much
-    contention we will not consume tokens and return False even if there might
-    be tokens available.
+    earlier requests will get the tokens. Requests are serialized by arango,
+    so contention slows them down but never causes tokens to be denied when
+    they were available.
+
+    If the first attempt fails it is attempted once more, after creating the
+    collection if it does not exist yet. Failures other than a missing
+    collection, such as a write-write conflict or a transient error from
+    arango, are logged before retrying. If the second attempt fails too, its
+    error is raised.
 
     Arguments:
         itgs (LazyIntegrations): The lazy integrations for connecting to arango
@@ -63,76 +71,154 @@ def consume(itgs, settings, consumer, amt) -> bool:
         consumer (str): The unique identifier for the consumer. For resources
             which are shared by all consumers just use any fixed value here.
         amt (int): The amount of tokens to consume
-        retry (int, None): This endpoint
 
     Returns:
         True if all amt tokens were available and consumed, False if they were
         not all available and the request should be rejected.
     """
-    for i in range(8):
-        try:
-            result = _consume(itgs, settings, consumer, amt)
-        except:  # noqa
-            if i != 0:
-                raise
-            result = None
+    return consume_batch(itgs, settings, consumer, [(None, amt)])[0]
+
+
+def consume_batch(itgs, settings, consumer, attempts) -> list:
+    """Makes several attempts to consume tokens from the given consumer, in
+    order, using a single request to arango. Each attempt is decided exactly
+    as if consume had been called at the given time, taking into account the
+    attempts before it, and nothing else can consume from this consumer in
+    between them. The request is retried once on failure, as described in
+    consume.
+
+    Arguments:
+        itgs (LazyIntegrations): The lazy integrations for connecting to arango
+        settings (Settings): The ratelimit settings
+        consumer (str): The unique identifier for the consumer.
+        attempts (list[tuple[int, int]]): The attempts to make, in order, each
+            as a pair `(at_ms, amt)`. `at_ms` is the time of the attempt in
+            milliseconds since the epoch, or None for the current time, and
+            must not be before the time of the previous attempt. `amt` is the
+            amount of tokens to consume.
+
+    Returns:
+        A list with one bool for each attempt; True if all of its tokens were
+        available and consumed, False if they were not and the request should
+        be rejected.
+    """
+    if not attempts:
+        return []
+
+    try:
+        return _consume_batch(itgs, settings, consumer, attempts)
+    except requests.exceptions.HTTPError as exc:
+        # a missing collection is expected for the first consume
+        if exc.response is None or exc.response.status_code != 404:
             itgs.logger.exception(Level.WARN)
+    except Exception:
+        itgs.logger.exception(Level.WARN)
+
+    if setup_tokens_collection(itgs, settings):
+        itgs.logger.print(
+            Level.INFO,
+            'lbshared.ratelimits auto-created tokens collection {}',
+            settings.collection_name
+        )
+
+    return _consume_batch(itgs, settings, consumer, attempts)
+
 
-        if result is not None:
-            return result
-
-        if i == 0:
-            if setup_tokens_collection(itgs, settings):
-                itgs.logger.print(
-                    Level.INFO,
-                    'lbshared.ratelimits auto-created tokens collection {}',
-                    settings.collection_name
-                )
-
-        time.sleep(min(0.05 * (2 ** i), 1))
-
-    return False
-
-
-def _consume(itgs, settings, consumer, amt):
-    doc = itgs.kvs_db.collection(settings.collection_name).document(consumer)
-
-    existed = doc.read()
-    cur_time = time.time()
-    if not existed:
-        doc.body = {
-            'tokens': settings.max_tokens,
-            'last_refill': cur_time
-        }
-    else:
-        time_since_refill = cur_time - doc.body['last_refill']
-        num_refills = int((time_since_refill * 1000) / settings.refill_time_ms)
-        doc.body['tokens'] = min(
-            settings.max_tokens,
-            doc.body['tokens'] + num_refills * settings.refill_amount
+@functools.lru_cache(maxsize=16)
+def _consume_query(num_attempts):
+    """Get the AQL query which makes the given number of attempts to consume
+    tokens from a single consumer. This follows the same steps as reading the
+    document, refilling, consuming, and writing it back through arango_crud
+    would, except the server does all of it while it holds an exclusive lock
+    on the collection, so there's no conflict to retry. The document layout is
+    the one arango_crud uses, so the tokens can still be read with
+    `coll.document(consumer).read()`.
+
+    Documents written before `last_refill_ms` was added only have
+    `last_refill`, in seconds. It only moves forward, so the later of the two
+    is current. We keep writing `last_refill` for older versions which may
+    still be running against the same collection.
+
+    AQL can't carry state between the iterations of a loop, so each attempt is
+    a separate set of statements. The attempt with index `i` takes the bind
+    variables `at_ms_i` and `amt_i`.
+    """
+    lines = [
+        'LET old = DOCUMENT(@@collection, @key)',
+        'LET state_0 = old == null ? null : {',
+        '    tokens: old.value.tokens,',
+        '    last_refill_ms: MAX([',
+        '        old.value.last_refill_ms,',
+        '        FLOOR(old.value.last_refill * 1000)',
+        '    ])',
+        '}',
+    ]
+    for i in range(num_attempts):
+        lines.extend(
+            line.format(i=i, prev=f'state_{i}', next=f'state_{i + 1}')
+            for line in (
+                'LET last_refill_ms_{i} = {prev} == null ? @at_ms_{i} : {prev}.last_refill_ms',
+                'LET num_refills_{i} = {prev} == null ? 0 : MAX([',
+                '    0, FLOOR((@at_ms_{i} - last_refill_ms_{i}) / @refill_time_ms)',
+                '])',
+                'LET available_{i} = {prev} == null ? @max_tokens : MIN([',
+                '    @max_tokens,',
+                '    {prev}.tokens + num_refills_{i} * @refill_amount',
+                '])',
+                'LET consumed_{i} = available_{i} >= @amt_{i}',
+                'LET {next} = {{',
+                '    tokens: consumed_{i} ? available_{i} - @amt_{i} : available_{i},',
+                '    last_refill_ms: (!consumed_{i} && @strict) ? @at_ms_{i} : (',
+                '        last_refill_ms_{i} + num_refills_{i} * @refill_time_ms',
+                '    )',
+                '}}',
+            )
         )
-        doc.body['last_refill'] += num_refills * (settings.refill_time_ms / 1000.0)
-
-    if doc.body['tokens'] >= amt:
-        doc.body['tokens'] -= amt
-        consumed = True
-    else:
-        if settings.strict:
-            doc.body['last_refill'] = cur_time
-        consumed = False
-
-    refills_until_full = math.ceil(
-        float(settings.max_tokens - doc.body['tokens']) / settings.refill_amount
-    )
-    time_full_at = doc.body['last_refill'] + (refills_until_full * settings.refill_time_ms / 1000.0)
-    seconds_until_full = time_full_at - cur_time
-    ttl = math.ceil(seconds_until_full)
-
-    if existed:
-        success = doc.compare_and_swap(ttl=ttl)
-    else:
-        success = doc.create(ttl=ttl)
-
-    if not success:
-        return None
-    return consumed
+
+    last = f'state_{num_attempts}'
+    lines.extend((
+        f'LET full_at_ms = {last}.last_refill_ms + (',
+        f'    CEIL((@max_tokens - {last}.tokens) / @refill_amount) * @refill_time_ms',
+        ')',
+        'LET doc = {',
+        f'    expires_at: DATE_ISO8601(MAX([full_at_ms, @at_ms_{num_attempts - 1}])),',
+        '    value: {',
+        f'        tokens: {last}.tokens,',
+        f'        last_refill_ms: {last}.last_refill_ms,',
+        f'        last_refill: {last}.last_refill_ms / 1000',
+        '    }',
+        '}',
+        'UPSERT { _key: @key }',
+        'INSERT MERGE({ _key: @key }, doc)',
+        'REPLACE MERGE({ _key: @key }, doc)',
+        'IN @@collection OPTIONS { exclusive: true }',
+        'RETURN [{}]'.format(', '.join(f'consumed_{i}' for i in range(num_attempts))),
+    ))
+    return '\n'.join(lines)
+
+
+def _consume_batch(itgs, settings, consumer, attempts):
+    bind_vars = {
+        '@collection': settings.collection_name,
+        'key': consumer,
+        'max_tokens': settings.max_tokens,
+        'refill_amount': settings.refill_amount,
+        'refill_time_ms': settings.refill_time_ms,
+        'strict': settings.strict
+    }
+    now_ms = None
+    for i, (at_ms, amt) in enumerate(attempts):
+        if at_ms is None:
+            if now_ms is None:
+                now_ms = _now_ms()
+            at_ms = now_ms
+        bind_vars[f'at_ms_{i}'] = at_ms
+        bind_vars[f'amt_{i}'] = amt
+
+    return aql.execute(itgs.kvs_db, _consume_query(len(attempts)), bind_vars)[0]
+
+
+def _now_ms():
+    """The current time in milliseconds since the epoch. This is what the
+    tokens are refilled against; tests replace it to control the clock."""
+    return time.time_ns() // 1000000
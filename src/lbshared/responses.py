@@ -2,8 +2,48 @@
 from .lazy_integrations import LazyIntegrations
 from lblogging import Level
 from pypika import PostgreSQLQuery as Query, Table, Parameter
+from pypika.terms import Function
+import psycopg2.extensions
+import os
+import threading
+import time
 import traceback
 
+CACHE_TIME_SECONDS = float(os.environ.get('RESPONSE_CACHE_TIME_SECONDS', '60'))
+"""How long a response body is reused before it's fetched from the database
+again. Response bodies change very rarely, so this only bounds how long it
+takes for edits to be noticed."""
+
+MISSING_CACHE_TIME_SECONDS = min(CACHE_TIME_SECONDS, 5)
+"""How long we remember that a response does not exist. This is shorter than
+CACHE_TIME_SECONDS so that newly added responses are picked up quickly."""
+
+CACHE_MAX_SIZE = 512
+"""The maximum number of response names to remember at once."""
+
+_RESPONSES = Table('responses')
+
+_SELECT_BODY_SQL = (
+    Query.from_(_RESPONSES).select(_RESPONSES.response_body)
+    .where(_RESPONSES.name == Parameter('%s')).limit(1).get_sql()
+)
+"""Selects the body of the response with a given name"""
+
+_SELECT_BODIES_SQL = (
+    Query.from_(_RESPONSES).select(_RESPONSES.name, _RESPONSES.response_body)
+    .where(_RESPONSES.name == Function('ANY', Parameter('%s'))).get_sql()
+)
+"""Selects the name and body of each response whose name is in a given list"""
+
+_NO_WRITES_SQL = Query.select(Function('txid_current_if_assigned').isnull()).get_sql()
+"""Selects if the current transaction has not written anything yet"""
+
+_CACHE_LOCK = threading.Lock()
+_CACHE = {}
+"""Maps from response names to a tuple of (expires_at, response_body), where
+expires_at is in terms of time.monotonic() and response_body is None if the
+response does not exist. Must only be accessed while holding _CACHE_LOCK."""
+
 
 class DefaultDictWithKeyArg(dict):
     """Essentially a default dictionary, except it passes the name of the
@@ -15,6 +55,31 @@ class DefaultDictWithKeyArg(dict):
         return self.default(key)
 
 
+class _SubstitutionDict(dict):
+    """The substitutions for formatting a response, which logs and returns a
+    placeholder for any substitution that the response uses but which was not
+    provided. The list of known substitutions for the log message is only
+    built on the first miss, and then reused for any later misses."""
+    __slots__ = ('itgs', 'name', 'keys_str')
+
+    def __init__(self, itgs, name, replacements):
+        super().__init__(replacements)
+        self.itgs = itgs
+        self.name = name
+        self.keys_str = None
+
+    def __missing__(self, key):
+        if self.keys_str is None:
+            self.keys_str = ', '.join(self.keys())
+        self.itgs.logger.print(
+            Level.WARN,
+            'While formatting response {} there was a request to substitute {} '
+            'but the only known substitutions are {}',
+            self.name, key, self.keys_str
+        )
+        return f'[ERROR: unknown substitution "{key}"]'
+
+
 def get_response(itgs: LazyIntegrations, name: str, **replacements):
     """Get the formatted response with the given name using the given
     substitutions. Every substitution is formatted using str(), if replacements
@@ -22,6 +87,10 @@ def get_response(itgs: LazyIntegrations, name: str, **replacements):
     response will be returned. If replacements contains keys not expected
     by the response they are simply ignored.
 
+    Response bodies are cached for CACHE_TIME_SECONDS, see invalidate_response.
+    Bodies read in a transaction which has written to the database are not
+    cached, since that transaction may still be rolled back.
+
     @param [LazyIntegrations] itgs The lazy integrations to use for connecting
         to the database and/or logger. This will only use a read cursor on the
         database.
@@ -30,14 +99,13 @@ def get_response(itgs: LazyIntegrations, name: str, **replacements):
       the response body to an object which will be stringified.
     @return [str] The formatted response.
     """
-    responses = Table('responses')
-    itgs.read_cursor.execute(
-        Query.from_(responses).select(responses.response_body)
-        .where(responses.name == Parameter('%s')).limit(1).get_sql(),
-        (name,)
-    )
-    row = itgs.read_cursor.fetchone()
-    if row is None:
+    return _format(itgs, name, _fetch_unformatted(itgs, (name,))[name], replacements)
+
+
+def _format(itgs: LazyIntegrations, name: str, unformatted: str, replacements: dict):
+    """Formats the given unformatted response body as described in
+    get_response, where unformatted is None if the response does not exist"""
+    if unformatted is None:
         itgs.logger.print(
             Level.WARN,
             'There was a request to format the response {} which is not a '
@@ -46,21 +114,107 @@ def get_response(itgs: LazyIntegrations, name: str, **replacements):
             name, ''.join(traceback.format_stack())
         )
         return f'ERROR: Unknown response: "{name}"'
-    (unformatted,) = row
 
-    def factory(key):
-        itgs.logger.print(
-            Level.WARN,
-            'While formatting response {} there was a request to substitute {} '
-            'but the only known substitutions are {}',
-            name, key, ', '.join(replacements.keys())
-        )
-        return f'[ERROR: unknown substitution "{key}"]'
+    return unformatted.format_map(_SubstitutionDict(itgs, name, replacements))
+
+
+def invalidate_response(name: str = None):
+    """Forget the cached body for the response with the given name, so that
+    the next request to format it fetches it from the database. This should be
+    called after a response is modified in order for the change to take effect
+    immediately in this process. Other processes will see the change within
+    CACHE_TIME_SECONDS regardless.
+
+    @param [str, None] name The name of the response to forget, or None to
+        forget every response.
+    """
+    with _CACHE_LOCK:
+        if name is None:
+            _CACHE.clear()
+        else:
+            _CACHE.pop(name, None)
+
+
+def _fetch_unformatted(itgs: LazyIntegrations, names: tuple):
+    """Fetch the unformatted bodies of the responses with the given names,
+    using the cache where possible. The responses which are not cached are
+    fetched from the database in a single query.
+
+    @param [LazyIntegrations] itgs The lazy integrations to use for connecting
+        to the database if any of the responses are not cached.
+    @param [tuple[str]] names The names of the responses to fetch
+    @return [dict[str, str]] Maps from each name to the unformatted response
+        body, or None if there is no response with that name.
+    """
+    now = time.monotonic()
+    result = _get_cached(names, now)
+    missing = [name for name in names if name not in result]
+    if not missing:
+        return result
+
+    committed = _sees_only_committed(itgs)
+    fetched = _select_unformatted(itgs, missing)
+    if committed:
+        _set_cached(fetched, now)
+    result.update(fetched)
+    return result
+
+
+def _sees_only_committed(itgs: LazyIntegrations):
+    """Determines if a read made now with the read cursor can only see
+    committed data, i.e., there is no transaction open on the read connection
+    or the open one has not written anything. Anything else could be rolled
+    back, and so must not be cached for other callers."""
+    if itgs.read_conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return True
+
+    itgs.read_cursor.execute(_NO_WRITES_SQL)
+    return itgs.read_cursor.fetchone()[0]
+
+
+def _get_cached(names: tuple, now: float):
+    """Get the cached bodies of the responses with the given names which have
+    not expired as of now. The result maps from names to bodies and does not
+    contain the names which are not cached."""
+    result = {}
+    with _CACHE_LOCK:
+        for name in names:
+            cached = _CACHE.get(name)
+            if cached is not None and cached[0] > now:
+                result[name] = cached[1]
+    return result
+
+
+def _select_unformatted(itgs: LazyIntegrations, names: list):
+    """Fetch the unformatted bodies of the responses with the given names from
+    the database in a single query, ignoring the cache. The result maps from
+    each name to its body, or None if there is no response with that name."""
+    result = dict.fromkeys(names)
+    if len(names) == 1:
+        itgs.read_cursor.execute(_SELECT_BODY_SQL, (names[0],))
+        row = itgs.read_cursor.fetchone()
+        if row is not None:
+            result[names[0]] = row[0]
+    else:
+        itgs.read_cursor.execute(_SELECT_BODIES_SQL, (names,))
+        for (name, unformatted) in itgs.read_cursor.fetchall():
+            result[name] = unformatted
+    return result
+
 
-    format_dict = DefaultDictWithKeyArg(factory)
-    for k, v in replacements.items():
-        format_dict[k] = v
-    return unformatted.format_map(format_dict)
+def _set_cached(fetched: dict, now: float):
+    """Cache the given response bodies, which were fetched from the database
+    at now, making room if the cache is full. None is cached as missing."""
+    with _CACHE_LOCK:
+        for (name, unformatted) in fetched.items():
+            ttl = CACHE_TIME_SECONDS if unformatted is not None else MISSING_CACHE_TIME_SECONDS
+            if name not in _CACHE and len(_CACHE) >= CACHE_MAX_SIZE:
+                for key in [k for (k, (expires_at, _)) in _CACHE.items() if expires_at <= now]:
+                    del _CACHE[key]
+                if len(_CACHE) >= CACHE_MAX_SIZE:
+                    # dicts are in insertion order, so this is the oldest entry
+                    del _CACHE[next(iter(_CACHE))]
+            _CACHE[name] = (now + ttl, unformatted)
 
 
 def get_letter_response(itgs: LazyIntegrations, base_name: str, **replacements):
@@ -83,7 +237,10 @@ def get_letter_response(itgs: LazyIntegrations, base_name: str, **replacements):
     @return [str, str] Two tuples; the first is the formatted title and the
         second is the formatted body.
     """
+    title_name = base_name + '_title'
+    body_name = base_name + '_body'
+    unformatted = _fetch_unformatted(itgs, (title_name, body_name))
     return (
-        get_response(itgs, base_name + '_title', **replacements),
-        get_response(itgs, base_name + '_body', **replacements)
+        _format(itgs, title_name, unformatted[title_name], replacements),
+        _format(itgs, body_name, unformatted[body_name], replacements)
     )
@@ -4,7 +4,6 @@ booted and, if it was too recent, will sleep a little bit. Typically called
 at the start of the program.
 """
 import os
-import json
 import time
 
 
@@ -20,23 +19,36 @@ def handle(time_between_restarts=10):
     store_opened_at()
 
     if last_open_at is not None:
-        time_since_opened = time.time() - last_open_at
+        time_since_opened = _now() - last_open_at
         if time_since_opened < time_between_restarts:
-            time.sleep(time_between_restarts - time_since_opened)
+            _sleep(time_between_restarts - time_since_opened)
 
 
 def last_opened_at():
-    """Determines when store_opened_at was last called"""
-    if not os.path.exists(FILENAME):
+    """Determines when store_opened_at was last called. This is stored as the
+    modification time of FILENAME, so the file's contents are never read."""
+    try:
+        return os.stat(FILENAME).st_mtime
+    except FileNotFoundError:
         return None
 
-    with open(FILENAME, 'r') as f:
-        body = json.load(f)
-
-    return body['last_started_at']
-
 
 def store_opened_at():
     """Updates the retry helper file to indicate we were just run"""
-    with open(FILENAME, 'w') as f:
-        json.dump({'last_started_at': time.time()}, f)
+    with open(FILENAME, 'a'):
+        pass
+    # The timestamp is set explicitly since the kernel stamps writes using a
+    # coarser clock than time.time()
+    now = _now()
+    os.utime(FILENAME, (now, now))
+
+
+def _now():
+    """The current time in seconds since the epoch. Tests replace this and
+    _sleep to check the delay without waiting for it."""
+    return time.time()
+
+
+def _sleep(seconds):
+    """Waits for the given number of seconds"""
+    time.sleep(seconds)
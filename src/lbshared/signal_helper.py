@@ -8,12 +8,21 @@ For obvious reasons, this signal helper doesn't prevent the program from being
 shutdown from SIGQUIT or pulling the plug on the server.
 """
 import signal
+import threading
 import typing
 import os
 from contextlib import contextmanager
 from .lazy_integrations import LazyIntegrations
 from lblogging import Level
 
+_LOCAL = threading.local()
+"""Holds `itgs_stack`, the integrations passed to each delay_signals block the
+current thread is in, innermost last. Only the outermost block swaps the
+signal handlers; nested blocks just push onto this stack."""
+
+_CAPTURED = set()
+"""The signals received since the outermost block began"""
+
 
 @contextmanager
 def delay_signals(itgs: typing.Optional[LazyIntegrations] = None):
@@ -21,14 +30,25 @@ def delay_signals(itgs: typing.Optional[LazyIntegrations] = None):
     are provided, they are used for logging. This operation MAY be nested.
     This will only re-raise the most urgent signal received while delaying,
     so for example if this gets both a SIGINT and a SIGTERM, only SIGTERM is
-    re-raised at the end of the block. Re-raising both would be unreliable."""
-    callback, tmp_handlers = _get_delayed_handlers(itgs)
-    old_handlers = _apply_handlers(*tmp_handlers)
+    re-raised at the end of the block. Re-raising both would be unreliable.
+
+    When nested, signals are delayed until the end of the outermost block."""
+    stack = getattr(_LOCAL, 'itgs_stack', None)
+    if stack is None:
+        stack = []
+        _LOCAL.itgs_stack = stack
+
+    old_handlers = None
+    if not stack:
+        old_handlers = _apply_handlers(_capture, _capture)
+    stack.append(itgs)
     try:
         yield
     finally:
-        _apply_handlers(*old_handlers)
-        callback()
+        stack.pop()
+        if old_handlers is not None:
+            _apply_handlers(*old_handlers)
+            _reraise_captured(itgs)
 
 
 def _apply_handlers(sigint_handler, sigterm_handler):
@@ -39,32 +59,29 @@ def _apply_handlers(sigint_handler, sigterm_handler):
     return (old_sigint, old_sigterm)
 
 
-def _get_delayed_handlers(itgs: typing.Optional[LazyIntegrations]):
-    """Get the handlers to use for sigint and sigterm signals"""
-    captured_sigint = False
-    captured_sigterm = False
-
-    def capture_sigint(sig_num=None, frame=None):
-        nonlocal captured_sigint
-        _log_capture(itgs, 'SIGINT')
-        captured_sigint = True
-
-    def capture_sigterm(sig_num=None, frame=None):
-        nonlocal captured_sigterm
-        _log_capture(itgs, 'SIGTERM')
-        captured_sigterm = True
-
-    def callback():
-        if captured_sigterm:
-            _log_reraise(itgs, 'SIGTERM')
-            _raise_signal(signal.SIGTERM)
-            return
-        if captured_sigint:
-            _log_reraise(itgs, 'SIGINT')
-            _raise_signal(signal.SIGINT)
-            return
-
-    return callback, (capture_sigint, capture_sigterm)
+def _capture(sig_num, frame=None):
+    """The handler for SIGINT and SIGTERM while signals are being delayed.
+    Signal handlers always run on the main thread, which is the only thread
+    that can have installed this handler."""
+    itgs = next((i for i in reversed(_LOCAL.itgs_stack) if i is not None), None)
+    _log_capture(itgs, signal.Signals(sig_num).name)
+    _CAPTURED.add(sig_num)
+
+
+def _reraise_captured(itgs: typing.Optional[LazyIntegrations]):
+    """Re-raises the most urgent signal which was captured, if any. Must be
+    called after the original handlers have been restored."""
+    captured = _CAPTURED.copy()
+    _CAPTURED.clear()
+
+    if signal.SIGTERM in captured:
+        _log_reraise(itgs, 'SIGTERM')
+        _raise_signal(signal.SIGTERM)
+        return
+    if signal.SIGINT in captured:
+        _log_reraise(itgs, 'SIGINT')
+        _raise_signal(signal.SIGINT)
+        return
 
 
 def _log_capture(itgs, signm):
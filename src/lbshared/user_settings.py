@@ -10,9 +10,13 @@ from and only includes the differences from those defaults. This saves storage
 space.
 """
 from pydantic import BaseModel
-from pypika import PostgreSQLQuery as Query, Table, Parameter
+import psycopg2.extras
+from collections import OrderedDict
+import asyncio
 import time
 import json
+import random
+import threading
 import requests.exceptions
 
 
@@ -71,13 +75,55 @@ in ascending time order. We freeze users to a particular index in this,
 whatever the last index is at the time, and then store modifications.
 """
 
-SETTINGS_KEYS = tuple(DEFAULTS[-1].dict().keys())
+DEFAULT_DICTS = [d.dict() for d in DEFAULTS]
+"""The same defaults as DEFAULTS, as plain dictionaries. These are what we
+actually read from, since indexing a dict is much cheaper than going through
+the pydantic model for every key."""
+
+SETTINGS_KEYS = tuple(UserSettings.__fields__.keys())
 """The settings keys, which we use for fetching settings programmatically,
 stored so we don't have to constantly regenerate them"""
 
+SETTINGS_KEYS_SET = frozenset(SETTINGS_KEYS)
+"""The same keys as SETTINGS_KEYS, for quickly filtering the keys we store"""
+
 USER_SETTINGS_COLLECTION = 'user-settings'
 """The collection within arango that we store user settings at."""
 
+_INSERT_EVENTS_SQL = (
+    'INSERT INTO user_settings_events '
+    '(user_id, changer_user_id, property_name, old_value, new_value) VALUES %s'
+)
+"""Inserts user settings events; this is meant for execute_values, which
+expands the placeholder to one row per event. Each row is the user id, the
+changer user id, the property name, and the old and new values"""
+
+_JSON_ENCODE = json.JSONEncoder(separators=(',', ':')).encode
+"""Serializes the old and new values for settings events. This is the same as
+json.dumps without whitespace, except the encoder is only constructed once."""
+
+_MISSING = object()
+"""Sentinel for dict.pop, to tell a removed key from one that wasn't there"""
+
+_COLLECTIONS = {}
+"""Caches the user settings collection handle for each database handle, keyed
+by the id of the database handle. See _user_settings_collection."""
+
+_COLLECTIONS_MAX_SIZE = 64
+"""The number of collection handles we cache before starting over. Database
+handles are reused per-thread by LazyIntegrations, so in practice there is
+only one per thread."""
+
+CONTENTION_MAX_SIZE = 1024
+"""The maximum number of users whose recent contention in set_settings we
+remember. The least recently contended users are forgotten first."""
+
+_CONTENTION_LOCK = threading.Lock()
+_CONTENTION = OrderedDict()
+"""Maps user ids to a decaying count of how often set_settings has had to
+retry for that user, in least recently updated order. See _record_contention.
+"""
+
 
 def get_settings(itgs, user_id: int) -> UserSettings:
     """Get the settings for the given user.
@@ -90,7 +136,7 @@ def get_settings(itgs, user_id: int) -> UserSettings:
     Returns:
     - `settings (UserSettings)`: The settings for that user.
     """
-    coll = itgs.kvs_db.collection(USER_SETTINGS_COLLECTION)
+    coll = _user_settings_collection(itgs)
     doc = coll.document(str(user_id))
 
     if not doc.read():
@@ -102,20 +148,22 @@ def get_settings(itgs, user_id: int) -> UserSettings:
             coll.create_if_not_exists(ttl=None)
             successful_create = doc.create()
 
-        if not successful_create:
-            doc.read()
+        # Arango doesn't include the winning document when the create
+        # conflicts, so it has to be fetched. If it was deleted in the meantime
+        # the user still has the defaults, which is just what we tried to store
+        if not successful_create and not doc.read():
+            doc.body['frozen'] = len(DEFAULTS) - 1
 
-    base_settings = DEFAULTS[doc.body['frozen']]
+    # We only store the settings which differ from the defaults, which is
+    # usually none of them
+    settings = DEFAULT_DICTS[doc.body['frozen']].copy()
+    for nm in SETTINGS_KEYS_SET.intersection(doc.body):
+        settings[nm] = doc.body[nm]
 
-    return UserSettings(
-        **dict(
-            [nm, doc.body.get(nm, getattr(base_settings, nm))]
-            for nm in SETTINGS_KEYS
-        )
-    )
+    return UserSettings(**settings)
 
 
-def set_settings(itgs, user_id: int, **values) -> list:
+def set_settings(itgs, user_id: int, **values) -> dict:
     """Set the given settings on the user. It's more efficient to do fewer
     calls with more values than more calls with fewer values. This guarrantees
     that the entire change is made, however of course if several calls
@@ -139,48 +187,152 @@ def set_settings(itgs, user_id: int, **values) -> list:
         has keys which are a subset of the keys of values. The keys from values
         which were going to be set to the same value they are currently are
         stripped. Each value in change has the following keys:
-        + `old (any)`: The old value for this property
+        + `old (any)`: The old value for this property, as it was stored
+            immediately before this change was written. If another writer
+            changed the property while we were retrying this is their value,
+            not the one from before this call, so that the settings events
+            form an unbroken history.
         + `new (any)`: The new value for this property
     """
-    doc = itgs.kvs_db.collection(USER_SETTINGS_COLLECTION).document(str(user_id))
-    if not doc.read():
-        doc.body['frozen'] = len(DEFAULTS) - 1
-        if not doc.create():
-            if not doc.read():
-                raise Exception('High contention on user settings object!')
+    steps = _set_settings_steps(itgs, user_id, values)
+    try:
+        while True:
+            time.sleep(next(steps))
+    except StopIteration as exc:
+        return exc.value
+
+
+async def aset_settings(itgs, user_id: int, **values) -> dict:
+    """The same as set_settings, except that it waits between retries using
+    asyncio.sleep, so that the event loop can keep running while we back off
+    from a contended user.
+
+    The requests to arango are still made synchronously on the event loop,
+    since arango_crud has no asynchronous interface. They are typically much
+    shorter than the back-off.
 
+    See set_settings for the arguments and return value.
+    """
+    steps = _set_settings_steps(itgs, user_id, values)
+    try:
+        while True:
+            await asyncio.sleep(next(steps))
+    except StopIteration as exc:
+        return exc.value
+
+
+def _set_settings_steps(itgs, user_id, values):
+    """Sets the given values on the given user, implementing set_settings and
+    aset_settings. This yields the number of seconds to wait each time it has
+    to back off and returns the changes, so that it can be driven either by
+    sleeping or by awaiting."""
+    doc = _user_settings_collection(itgs).document(str(user_id))
+    _read_or_create(doc)
+    if not values:
+        return {}
+
+    # Users which were contended recently start further along the back-off,
+    # so that retries for hot users spread out quickly without slowing down
+    # anyone else. The jitter is so that the writers don't retry in lockstep.
+    with _CONTENTION_LOCK:
+        prior_contention = min(_CONTENTION.get(user_id, 0), 5)
+
+    failures = 0
     for i in range(10):
         if i > 0:
-            time.sleep(0.1 * (2 ** i))
-
-        base_settings = DEFAULTS[doc.body['frozen']]
-
-        changes = {}
-        for key, val in values.items():
-            def_val = getattr(base_settings, key)
-            old_val = doc.body.get(key, def_val)
-            if old_val != val:
-                changes[key] = {
-                    'old': old_val,
-                    'new': val
-                }
-
-            if val == def_val:
-                if key in doc.body:
-                    del doc.body[key]
-            else:
-                doc.body[key] = val
-
-        if doc.compare_and_swap():
+            yield _back_off_seconds(i, prior_contention)
+
+        changes, body_mutated = _apply_values(doc, values)
+        # If the body is unchanged, we just read the document and it already
+        # has these values
+        if not body_mutated or doc.compare_and_swap():
+            _record_contention(user_id, failures)
             return changes
 
+        failures += 1
         if not doc.read():
             doc.body = {}
             doc.body['frozen'] = len(DEFAULTS) - 1
             if not doc.create():
                 raise Exception(f'Ludicrously high contention on user settings for {user_id}')
 
-    raise Exception('All 10 attempts to set user settings failed')
+    _record_contention(user_id, failures)
+    raise Exception(
+        f'All 10 attempts to set user settings for {user_id} failed '
+        f'(recent contention: {prior_contention})'
+    )
+
+
+def _read_or_create(doc):
+    """Reads the given user settings document, creating it frozen to the
+    latest defaults if it doesn't exist yet."""
+    if not doc.read():
+        doc.body['frozen'] = len(DEFAULTS) - 1
+        if not doc.create():
+            if not doc.read():
+                raise Exception('High contention on user settings object!')
+
+
+def _apply_values(doc, values):
+    """Applies the given values to the body of the given user settings
+    document, which only stores the values which differ from its defaults.
+    Returns the changes as described in set_settings, and whether the body
+    was modified and so needs to be written."""
+    base_settings = DEFAULT_DICTS[doc.body['frozen']]
+
+    changes = {}
+    body_mutated = False
+    for key, val in values.items():
+        def_val = base_settings[key]
+        old_val = doc.body.get(key, def_val)
+        if old_val != val:
+            changes[key] = {
+                'old': old_val,
+                'new': val
+            }
+
+        if val == def_val:
+            if doc.body.pop(key, _MISSING) is not _MISSING:
+                body_mutated = True
+        elif key not in doc.body or doc.body[key] != val:
+            doc.body[key] = val
+            body_mutated = True
+    return changes, body_mutated
+
+
+def _back_off_seconds(attempt, prior_contention):
+    """The number of seconds to wait before the given attempt (starting at 1
+    for the first retry) to set the settings of a user which had the given
+    recent contention, with jitter."""
+    return random.uniform(0.005, min(0.5, 0.01 * (3 ** (attempt + prior_contention))))
+
+
+def _user_settings_collection(itgs):
+    """Get the handle for the user settings collection within the key-value
+    store database of the given integrations. The handle refers to the
+    database it came from, which keeps that database alive while it's cached,
+    so the identity check is enough to guard against a reused id."""
+    db = itgs.kvs_db
+    coll = _COLLECTIONS.get(id(db))
+    if coll is None or coll.database is not db:
+        coll = db.collection(USER_SETTINGS_COLLECTION)
+        if len(_COLLECTIONS) >= _COLLECTIONS_MAX_SIZE:
+            _COLLECTIONS.clear()
+        _COLLECTIONS[id(db)] = coll
+    return coll
+
+
+def _record_contention(user_id, failures):
+    """Remember that a call to set_settings for the given user had to retry
+    the given number of times. Older contention is halved each time so that
+    users which stop being contended are eventually forgotten."""
+    with _CONTENTION_LOCK:
+        contention = (_CONTENTION.pop(user_id, 0) // 2) + failures
+        if contention <= 0:
+            return
+        _CONTENTION[user_id] = contention
+        while len(_CONTENTION) > CONTENTION_MAX_SIZE:
+            _CONTENTION.popitem(last=False)
 
 
 def create_settings_events(
@@ -201,22 +353,16 @@ def create_settings_events(
         to false as it's easier to read controllers if all commits are explicit,
         i.e., the controller at least says `commit=True`
     """
-    events = Table('user_settings_events')
-    sql = (
-        Query.into(events).columns(
-            events.user_id, events.changer_user_id, events.property_name,
-            events.old_value, events.new_value
-        ).insert(*[tuple(Parameter('%s') for _ in range(5)) for _ in changes])
-        .get_sql()
-    )
-    args = []
-    for (prop_name, change) in changes.items():
-        args.append(user_id)
-        args.append(changer_user_id)
-        args.append(prop_name)
-        args.append(json.dumps(change['old']))
-        args.append(json.dumps(change['new']))
-
-    itgs.write_cursor.execute(sql, args)
+    rows = [
+        (
+            user_id, changer_user_id, prop_name,
+            _JSON_ENCODE(change['old']), _JSON_ENCODE(change['new'])
+        )
+        for (prop_name, change) in changes.items()
+    ]
+    if rows:
+        psycopg2.extras.execute_values(
+            itgs.write_cursor, _INSERT_EVENTS_SQL, rows, page_size=len(rows)
+        )
     if commit:
         itgs.write_conn.commit()
@@ -0,0 +1,50 @@
+"""Verifies that the AQL helpers can read documents which were written using
+arango_crud"""
+import unittest
+import sys
+import secrets
+
+sys.path.append("../src")
+
+from lbshared.lazy_integrations import LazyIntegrations  # noqa: E402
+import lbshared.aql as aql  # noqa: E402
+
+
+class TestAql(unittest.TestCase):
+    def test_execute(self):
+        with LazyIntegrations() as itgs:
+            db = itgs.kvs_conn.database('test_aql')
+            self.assertTrue(db.create_if_not_exists())
+            try:
+                self.assertEqual(aql.execute(db, 'RETURN @val', {'val': 5}), [5])
+                self.assertEqual(
+                    aql.execute(db, 'FOR i IN 1..5 RETURN i', batch_size=2),
+                    [1, 2, 3, 4, 5]
+                )
+            finally:
+                self.assertTrue(db.force_delete())
+
+    def test_read_docs(self):
+        with LazyIntegrations() as itgs:
+            db = itgs.kvs_conn.database('test_aql')
+            self.assertTrue(db.create_if_not_exists())
+            try:
+                coll = db.collection('test_aql')
+                self.assertTrue(coll.create_if_not_exists())
+
+                bodies = {secrets.token_urlsafe(): {'n': i} for i in range(3)}
+                for key, body in bodies.items():
+                    coll.create_or_overwrite_doc(key, body)
+
+                missing_key = secrets.token_urlsafe()
+                self.assertEqual(
+                    aql.read_docs(coll, list(bodies.keys()) + [missing_key]),
+                    bodies
+                )
+                self.assertEqual(aql.read_docs(coll, []), {})
+            finally:
+                self.assertTrue(db.force_delete())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Verifies that events can be stored in and paged through in the delayed
+queue"""
+import unittest
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append("../src")
+
+from lbshared.lazy_integrations import LazyIntegrations  # noqa: E402
+import lbshared.delayed_queue as delayed_queue  # noqa: E402
+
+
+QUEUE_TYPE = delayed_queue.QUEUE_TYPES['trust']
+
+
+class TestDelayedQueue(unittest.TestCase):
+    def test_index_events_pagination(self):
+        shared_at = datetime(2100, 1, 1)
+        event_ats = (
+            [shared_at - timedelta(hours=1)]
+            + [shared_at] * 5
+            + [shared_at + timedelta(hours=1)]
+        )
+
+        with LazyIntegrations() as itgs:
+            # Nothing is committed; index_events reads on the same connection
+            uuids = []
+            try:
+                for i, event_at in enumerate(event_ats):
+                    uuids.append(delayed_queue.store_event(
+                        itgs, QUEUE_TYPE, event_at, {'n': i}
+                    ))
+
+                expected = [
+                    (ev_uuid, {'n': i})
+                    for (ev_at, ev_uuid, i) in sorted(zip(event_ats, uuids, range(len(uuids))))
+                ]
+
+                # The bounds keep out any other events in the queue, and still
+                # apply alongside the cursor
+                after_time = shared_at - timedelta(hours=2)
+                for (before_time, expected_asc) in (
+                        (shared_at + timedelta(hours=2), expected),
+                        (shared_at + timedelta(minutes=30), expected[:-1])):
+                    for order in ('asc', 'desc'):
+                        with self.subTest(order=order, before_time=before_time):
+                            self.assertEqual(
+                                self._page_through(
+                                    itgs, order, len(expected),
+                                    before_time=before_time, after_time=after_time
+                                ),
+                                expected_asc if order == 'asc' else expected_asc[::-1]
+                            )
+            finally:
+                itgs.write_conn.rollback()
+                coll = itgs.kvs_db.collection('delayed_queue')
+                for ev_uuid in uuids:
+                    coll.force_delete_doc(ev_uuid)
+
+    def test_consume_events(self):
+        event_at = datetime.now() - timedelta(days=1)
+        with LazyIntegrations() as itgs:
+            uuids = [
+                delayed_queue.store_event(itgs, QUEUE_TYPE, event_at, {'n': i}, commit=True)
+                for i in range(3)
+            ]
+            try:
+                handled = {}
+
+                def handler(ev_uuid, ev_at, ev, ctx):
+                    handled[ev_uuid] = ev
+
+                def rollback(ev_uuid, ev_at, ev, ctx):
+                    self.fail(f'rollback called for {ev_uuid}')
+
+                delayed_queue.consume_events(itgs, QUEUE_TYPE, 100, handler, rollback)
+
+                coll = itgs.kvs_db.collection('delayed_queue')
+                for (i, ev_uuid) in enumerate(uuids):
+                    self.assertEqual(handled.get(ev_uuid), {'n': i})
+                    # the background delete is done by the time consume returns
+                    self.assertIsNone(coll.read_doc(ev_uuid))
+                    self.assertFalse(delayed_queue.delete_event(itgs, ev_uuid))
+            finally:
+                itgs.write_conn.rollback()
+                for ev_uuid in uuids:
+                    delayed_queue.delete_event(itgs, ev_uuid, commit=True)
+
+    def _page_through(self, itgs, order, num_events, **kwargs):
+        """Fetches the uuid and metadata of every event in the queue matching
+        the given index_events arguments two at a time, passing the last event
+        on each page as the cursor for the next page. Gives up after more pages
+        than there could be, in case pages repeat."""
+        result = []
+        cursor = None
+        for _ in range(num_events):
+            page = delayed_queue.index_events(
+                itgs, QUEUE_TYPE, 2, order=order, cursor=cursor, **kwargs
+            )
+            if not page:
+                break
+            result.extend((ev_uuid, ev) for (ev_uuid, _, ev) in page)
+            (ev_uuid, ev_at, _) = page[-1]
+            cursor = (ev_at, ev_uuid)
+        return result
+
+
+if __name__ == '__main__':
+    unittest.main()
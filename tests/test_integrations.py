@@ -22,6 +22,35 @@ class TestIntegrations(unittest.TestCase):
         finally:
             conn.close()
 
+    def test_database_pool(self):
+        pool = lbshared.integrations.database_pool()
+        self.assertIs(lbshared.integrations.database_pool(), pool)
+        conn = pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT NOW()')
+            row = cursor.fetchone()
+            self.assertIsNotNone(row)
+            self.assertEqual(len(row), 1)
+            cursor.close()
+        finally:
+            pool.putconn(conn)
+
+    def test_database_pool_keeps_concurrent(self):
+        pool = lbshared.integrations.database_pool()
+        conns = [pool.getconn(), pool.getconn()]
+        for conn in conns:
+            pool.putconn(conn)
+
+        # Both were kept open, so they're the ones handed out next
+        reused = [pool.getconn(), pool.getconn()]
+        try:
+            self.assertEqual(set(map(id, reused)), set(map(id, conns)))
+            self.assertFalse(any(conn.closed for conn in reused))
+        finally:
+            for conn in reused:
+                pool.putconn(conn)
+
     def test_amqp(self):
         amqp = lbshared.integrations.amqp()
         try:
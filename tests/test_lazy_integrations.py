@@ -3,11 +3,13 @@ module are able to service simple requests"""
 import unittest
 import sys
 import secrets
+import psycopg2.extensions
 from lblogging import Level
 
 sys.path.append("../src")
 
 from lbshared.lazy_integrations import LazyIntegrations  # noqa: E402
+import lbshared.lazy_integrations as lazy_integrations  # noqa: E402
 
 
 class TestIntegrations(unittest.TestCase):
@@ -18,6 +20,51 @@ class TestIntegrations(unittest.TestCase):
             self.assertIsNotNone(row)
             self.assertEqual(len(row), 1)
 
+    def test_database_reused(self):
+        with LazyIntegrations() as itgs:
+            conn = itgs.write_conn
+            itgs.write_cursor.execute('SELECT 1')
+
+        with LazyIntegrations() as itgs:
+            self.assertIs(itgs.write_conn, conn)
+            # the uncommitted transaction from the last use was rolled back
+            self.assertEqual(
+                itgs.write_conn.info.transaction_status,
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            )
+
+    def test_borrow_read_cursor(self):
+        conn, cursor = lazy_integrations.borrow_read_cursor()
+        try:
+            cursor.execute('SELECT NOW()')
+            row = cursor.fetchone()
+            self.assertIsNotNone(row)
+            self.assertEqual(len(row), 1)
+        finally:
+            lazy_integrations.return_read_cursor(conn, cursor)
+        self.assertTrue(cursor.closed)
+
+        # the connection went back to the pool with the transaction rolled back
+        with LazyIntegrations() as itgs:
+            self.assertIs(itgs.read_conn, conn)
+            self.assertEqual(
+                itgs.read_conn.info.transaction_status,
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            )
+
+    def test_closures_before_teardown(self):
+        seen = []
+        with LazyIntegrations() as itgs:
+            def closure(*args):
+                itgs.read_cursor.execute('SELECT 1')
+                seen.append(itgs.read_cursor.fetchone())
+
+            itgs.closures.append(closure)
+
+        self.assertEqual(seen, [(1,)])
+        # the connection the closure borrowed was still given back
+        self.assertIsNone(itgs._conn)
+
     def test_amqp(self):
         with LazyIntegrations() as itgs:
             itgs.channel.queue_declare('test_integrations')
@@ -32,6 +79,44 @@ class TestIntegrations(unittest.TestCase):
                 self.assertEqual(body, pub_body)
                 break
 
+    def test_amqp_reused(self):
+        with LazyIntegrations() as itgs:
+            amqp, channel = itgs.amqp_and_channel
+            itgs.channel.basic_publish(
+                exchange='', routing_key='test_integrations_unrouted', body=b'hello'
+            )
+            channel = channel.pika_channel
+
+        with LazyIntegrations() as itgs:
+            self.assertIs(itgs.amqp, amqp)
+            self.assertIs(itgs.channel.pika_channel, channel)
+            self.assertTrue(itgs.channel.is_open)
+
+    def test_amqp_not_reused_after_get(self):
+        with LazyIntegrations() as itgs:
+            itgs.channel.queue_declare('test_integrations')
+            itgs.channel.basic_publish(
+                exchange='', routing_key='test_integrations', body=b'hello'
+            )
+            # leave the delivery unacked; closing the channel requeues it
+            (mf, _, body) = itgs.channel.basic_get('test_integrations')
+            self.assertEqual(body, b'hello')
+            channel = itgs.channel.pika_channel
+
+        self.assertFalse(channel.is_open)
+        with LazyIntegrations() as itgs:
+            self.assertIsNot(itgs.channel.pika_channel, channel)
+            (mf, _, body) = itgs.channel.basic_get('test_integrations', auto_ack=True)
+            self.assertEqual(body, b'hello')
+
+    def test_amqp_not_reused_after_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            with LazyIntegrations() as itgs:
+                channel = itgs.channel.pika_channel
+                1 / 0
+
+        self.assertFalse(channel.is_open)
+
     def test_logger(self):
         with LazyIntegrations() as itgs:
             itgs.logger.print(Level.DEBUG, 'Hello world!')
@@ -2,6 +2,7 @@
 module are able to service simple requests"""
 import unittest
 import sys
+from unittest import mock
 from pypika import Query, Table
 
 sys.path.append("../src")
@@ -41,6 +42,23 @@ class TestIntegrations(unittest.TestCase):
             )
         )
 
+    def test_exists_reused(self):
+        users = Table('users')
+        cats = Table('cats')
+        crit = lbshared.pypika_crits.exists(
+            Query.from_(cats).where(cats.user_id == users.id)
+        )
+        query = Query.from_(users).select(users.id).where(crit)
+        expected = (
+            'SELECT "id" FROM "users" WHERE '
+            + 'EXISTS (SELECT FROM "cats" WHERE "cats"."user_id"="users"."id")'
+        )
+        self.assertEqual(query.get_sql(), expected)
+
+        with mock.patch.object(crit, '_render_container_sql') as render:
+            self.assertEqual(query.get_sql(), expected)
+            render.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,12 @@
 """Test the queries module"""
 import unittest
+import os
 import sys
+import math
 import time
+from contextlib import ExitStack
+from unittest import mock
+import requests
 
 sys.path.append("../src")
 
@@ -11,6 +16,11 @@ import lbshared.ratelimits  # noqa: E402
 
 COLLECTION = 'test_ratelimits'
 
+FAST = os.environ.get('FAST_TESTS') == '1'
+"""If True the ratelimits use a fake clock which the tests move forward
+instantly. Otherwise the tests really wait, which is slower but also verifies
+the ratelimits against the actual clock."""
+
 
 DEFAULT_SETTINGS = lbshared.ratelimits.Settings(
     collection_name=COLLECTION,
@@ -20,97 +30,197 @@ DEFAULT_SETTINGS = lbshared.ratelimits.Settings(
     strict=False
 )
 
+STRICT_SETTINGS = lbshared.ratelimits.Settings(
+    collection_name=COLLECTION,
+    max_tokens=10,
+    refill_amount=3,
+    refill_time_ms=DEFAULT_SETTINGS.refill_time_ms,
+    strict=True
+)
+
+SCENARIOS = (
+    ('consume from new', DEFAULT_SETTINGS, (
+        ('consume', 3, True),
+    )),
+    ('consume more than max from new', DEFAULT_SETTINGS, (
+        ('consume', 11, False),
+    )),
+    ('consume after no refills', DEFAULT_SETTINGS, (
+        ('consume', 5, True),
+        ('consume', 5, True),
+    )),
+    ('consume too much after no refills', DEFAULT_SETTINGS, (
+        ('consume', 5, True),
+        ('consume', 6, False),
+    )),
+    ('consume after single partial refill', DEFAULT_SETTINGS, (
+        ('consume', 5, True),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms),
+        ('consume', 6, True),
+    )),
+    ('consume after multiple partial refill', DEFAULT_SETTINGS, (
+        ('consume', 10, True),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms * 2),
+        ('consume', 6, True),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms * 2),
+        ('consume', 5, True),
+        ('consume', 2, False),
+    )),
+    ('consume after multiple to complete refill', DEFAULT_SETTINGS, (
+        ('consume', 10, True),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms * 4),
+        ('consume', 10, True),
+        ('expire',),
+        ('consume', 10, True),
+    )),
+    ('consume more than available not strict', DEFAULT_SETTINGS, (
+        ('consume', 10, True),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms / 3),
+        ('consume', 3, False),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms / 3),
+        ('consume', 3, False),
+        ('advance', DEFAULT_SETTINGS.refill_time_ms / 3),
+        ('consume', 3, True),
+    )),
+    ('consume more than available strict', STRICT_SETTINGS, (
+        ('consume', 10, True),
+        ('advance', STRICT_SETTINGS.refill_time_ms / 2),
+        ('consume', 3, False),
+        ('advance', STRICT_SETTINGS.refill_time_ms / 2),
+        ('consume', 3, False),
+        ('advance', STRICT_SETTINGS.refill_time_ms / 2),
+        ('consume', 3, False),
+    )),
+)
+"""The sequences of steps for test_scenarios; each is a name, the settings,
+and the steps. A step is either `('consume', amt, expected)`, `('advance', ms)`
+to move the clock forward, or `('expire',)` to delete the tokens document as
+if it had expired."""
+
 
 class TestRatelimits(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.exit_stack = ExitStack()
+        cls.itgs = cls.exit_stack.enter_context(LazyItgs())
+        cls.itgs.kvs_db.create_if_not_exists()
+        cls.itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            cls.itgs.kvs_db.force_delete()
+        finally:
+            cls.exit_stack.close()
+
     def setUp(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.create_if_not_exists()
+        self.reset()
+
+        self.now_ms = time.time_ns() // 1000000
+        if FAST:
+            # Rather than sleeping we move this clock forward, see advance
+            patcher = mock.patch.object(lbshared.ratelimits, '_now_ms', lambda: self.now_ms)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def reset(self):
+        """Forgets the tokens for the consumer. Every test only uses this one
+        key, so that's all we need to reset."""
+        self.itgs.kvs_db.collection(COLLECTION).force_delete_doc('foo')
+
+    def advance(self, ms):
+        """Moves the ratelimit clock forward by the given number of
+        milliseconds, rounded up. Unless FAST is set this sleeps for that
+        long."""
+        ms = math.ceil(ms)
+        self.now_ms += ms
+        if not FAST:
+            time.sleep(ms / 1000.0)
 
-    def tearDown(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.force_delete()
+    def test_consume_from_new_with_uninitialized_coll(self):
+        itgs = self.itgs
+        coll = itgs.kvs_db.collection(COLLECTION)
+        coll.force_delete()
+        # consume creates it, but the other tests shouldn't depend on that
+        self.addCleanup(coll.create_if_not_exists, ttl=1)
+        self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
+
+    def test_scenarios(self):
+        for name, settings, steps in SCENARIOS:
+            with self.subTest(name):
+                self.reset()
+                for step in steps:
+                    if step[0] == 'consume':
+                        _, amt, expected = step
+                        self.assertEqual(
+                            lbshared.ratelimits.consume(self.itgs, settings, 'foo', amt),
+                            expected
+                        )
+                    elif step[0] == 'advance':
+                        self.advance(step[1])
+                    else:
+                        # TTL can take way too long for us to actually test
+                        # reliably here since it happens occassionally in the
+                        # background, so we'll just fake it
+                        self.assertEqual(step[0], 'expire')
+                        self.itgs.kvs_db.collection(COLLECTION).force_delete_doc('foo')
+
+    def test_consume_batch_not_strict(self):
+        itgs = self.itgs
+        third = math.ceil(DEFAULT_SETTINGS.refill_time_ms / 3)
+        self.assertEqual(
+            lbshared.ratelimits.consume_batch(
+                itgs, DEFAULT_SETTINGS, 'foo',
+                [(self.now_ms + third * i, 10 if i == 0 else 3) for i in range(4)]
+            ),
+            [True, False, False, True]
+        )
 
-    def test_consume_from_new_with_initialized_coll(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
+    def test_consume_batch_strict(self):
+        settings = STRICT_SETTINGS
+        itgs = self.itgs
+        half = math.ceil(settings.refill_time_ms / 2)
+        self.assertEqual(
+            lbshared.ratelimits.consume_batch(
+                itgs, settings, 'foo',
+                [(self.now_ms + half * i, 10 if i == 0 else 3) for i in range(4)]
+            ),
+            [True, False, False, False]
+        )
 
-    def test_consume_from_new_with_uninitialized_coll(self):
-        with LazyItgs() as itgs:
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
-
-    def test_consume_more_than_max_from_new(self):
-        with LazyItgs() as itgs:
-            self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 11))
-
-    def test_consume_after_no_refills(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 5))
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 5))
-
-    def test_consume_too_much_after_no_refills(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 5))
-            self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 6))
-
-    def test_consume_after_single_partial_refill(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 5))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms / 1000.0)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 6))
-
-    def test_consume_after_multiple_partial_refill(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 10))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms * 2 / 1000.0)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 6))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms * 2 / 1000.0)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 5))
-            self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 2))
-
-    def test_consume_after_multiple_to_complete_refill(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 10))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms * 4 / 1000.0)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 10))
-            # TTL can take way too long for us to actually test reliably here since it happens
-            # occassionally in the background, so we'll just fake it
-            itgs.kvs_db.collection(COLLECTION).force_delete_doc('foo')
+    def test_consume_batch_continues(self):
+        itgs = self.itgs
+        self.assertEqual(lbshared.ratelimits.consume_batch(itgs, DEFAULT_SETTINGS, 'foo', []), [])
+        self.assertEqual(
+            lbshared.ratelimits.consume_batch(
+                itgs, DEFAULT_SETTINGS, 'foo', [(None, 5), (None, 4)]
+            ),
+            [True, True]
+        )
+        self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 2))
+
+    def test_consume_retries_after_error(self):
+        itgs = self.itgs
+        real_consume_batch = lbshared.ratelimits._consume_batch
+        calls = []
+
+        def conflict_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                response = requests.Response()
+                response.status_code = 409
+                raise requests.exceptions.HTTPError(response=response)
+            return real_consume_batch(*args)
+
+        with mock.patch.object(
+                lbshared.ratelimits, '_consume_batch', side_effect=conflict_once), \
+                mock.patch.object(itgs.logger, 'exception') as log_exception:
             self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 10))
 
-    def test_consume_more_than_available_not_strict(self):
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 10))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms / 3000.0)
-            self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms / 3000.0)
-            self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
-            time.sleep(DEFAULT_SETTINGS.refill_time_ms / 3000.0)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 3))
-
-    def test_consume_more_than_available_strict(self):
-        settings = lbshared.ratelimits.Settings(
-            collection_name=COLLECTION,
-            max_tokens=10,
-            refill_amount=3,
-            refill_time_ms=DEFAULT_SETTINGS.refill_time_ms,
-            strict=True
-        )
-        with LazyItgs() as itgs:
-            itgs.kvs_db.collection(COLLECTION).create_if_not_exists(ttl=1)
-            self.assertTrue(lbshared.ratelimits.consume(itgs, settings, 'foo', 10))
-            time.sleep(settings.refill_time_ms / 2000.0)
-            self.assertFalse(lbshared.ratelimits.consume(itgs, settings, 'foo', 3))
-            time.sleep(settings.refill_time_ms / 2000.0)
-            self.assertFalse(lbshared.ratelimits.consume(itgs, settings, 'foo', 3))
-            time.sleep(settings.refill_time_ms / 2000.0)
-            self.assertFalse(lbshared.ratelimits.consume(itgs, settings, 'foo', 3))
+        self.assertEqual(len(calls), 2)
+        log_exception.assert_called_once()
+        # only the retry consumed tokens
+        self.assertFalse(lbshared.ratelimits.consume(itgs, DEFAULT_SETTINGS, 'foo', 1))
 
 
 if __name__ == '__main__':
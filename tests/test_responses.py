@@ -10,6 +10,52 @@ import lbshared.responses as responses  # noqa: E402
 from lbshared.lazy_integrations import LazyIntegrations  # noqa: E402
 
 
+RESPS = Table('responses')
+
+INSERT_RESPONSE_SQL = (
+    Query.into(RESPS).columns(
+        RESPS.name,
+        RESPS.response_body,
+        RESPS.description
+    ).insert(*[Parameter('%s') for _ in range(3)])
+    .returning(RESPS.id).get_sql()
+)
+"""Inserts a response; takes the name, body, and description"""
+
+INSERT_LETTER_SQL = (
+    Query.into(RESPS).columns(
+        RESPS.name,
+        RESPS.response_body,
+        RESPS.description
+    ).insert(
+        *[tuple(Parameter('%s') for _ in range(3)) for _ in range(2)]
+    ).returning(RESPS.id).get_sql()
+)
+"""Inserts the title and body of a letter; takes the name, body, and
+description of each"""
+
+UPDATE_RESPONSE_BODY_SQL = (
+    Query.update(RESPS).set(RESPS.response_body, Parameter('%s'))
+    .where(RESPS.id == Parameter('%s'))
+    .get_sql()
+)
+"""Changes the body of a response; takes the new body and the id"""
+
+DELETE_RESPONSE_SQL = (
+    Query.from_(RESPS).delete()
+    .where(RESPS.id == Parameter('%s'))
+    .get_sql()
+)
+"""Deletes a response; takes the id"""
+
+DELETE_LETTER_SQL = (
+    Query.from_(RESPS).delete()
+    .where(RESPS.id.isin([Parameter('%s') for _ in range(2)]))
+    .get_sql()
+)
+"""Deletes the title and body of a letter; takes both ids"""
+
+
 class TestResponses(unittest.TestCase):
     def test_missing(self):
         with LazyIntegrations() as itgs:
@@ -18,24 +64,18 @@ class TestResponses(unittest.TestCase):
             self.assertIn('my_missing_key', res)
 
     def test_existing(self):
-        resps = Table('responses')
         with LazyIntegrations() as itgs:
+            # get_response reads on the same connection, so it can see the row
+            # without it ever being committed
             itgs.write_cursor.execute(
-                Query.into(resps).columns(
-                    resps.name,
-                    resps.response_body,
-                    resps.description
-                ).insert(*[Parameter('%s') for _ in range(3)])
-                .returning(resps.id).get_sql(),
+                INSERT_RESPONSE_SQL,
                 (
                     'my_response',
                     'I like to {foo} the {bar}',
                     'Testing desc'
                 )
             )
-            (respid,) = itgs.write_cursor.fetchone()
             try:
-                itgs.write_conn.commit()
                 res: str = responses.get_response(itgs, 'my_response', foo='open', bar='door')
                 self.assertEqual(res, 'I like to open the door')
 
@@ -45,15 +85,93 @@ class TestResponses(unittest.TestCase):
                 # it's not important how we choose to format the error, but it
                 # needs the missing key or debugging will be a pain
                 self.assertIn('bar', res)
+
+                # Once the row is rolled back and forgotten, the response is
+                # fetched again and is gone
+                itgs.write_conn.rollback()
+                responses.invalidate_response('my_response')
+                res: str = responses.get_response(itgs, 'my_response', foo='open', bar='door')
+                self.assertIn('my_response', res)
+                self.assertNotIn('I like to', res)
+            finally:
+                itgs.write_conn.rollback()
+                responses.invalidate_response('my_response')
+
+    def test_uncommitted_not_cached(self):
+        with LazyIntegrations() as itgs:
+            itgs.write_cursor.execute(
+                INSERT_RESPONSE_SQL,
+                (
+                    'my_response',
+                    'I like to {foo}',
+                    'Testing desc'
+                )
+            )
+            try:
+                res: str = responses.get_response(itgs, 'my_response', foo='sing')
+                self.assertEqual(res, 'I like to sing')
+
+                # Without invalidating, the rolled back body must not be served
+                itgs.write_conn.rollback()
+                res: str = responses.get_response(itgs, 'my_response', foo='sing')
+                self.assertNotIn('I like to', res)
             finally:
                 itgs.write_conn.rollback()
+                responses.invalidate_response('my_response')
+
+    def test_invalidate(self):
+        with LazyIntegrations() as itgs:
+            itgs.write_cursor.execute(
+                INSERT_RESPONSE_SQL,
+                (
+                    'my_response',
+                    'I like to {foo}',
+                    'Testing desc'
+                )
+            )
+            (respid,) = itgs.write_cursor.fetchone()
+            try:
+                itgs.write_conn.commit()
+                res: str = responses.get_response(itgs, 'my_response', foo='sing')
+                self.assertEqual(res, 'I like to sing')
+
+                # The body is served from the cache, so the edit isn't seen
                 itgs.write_cursor.execute(
-                    Query.from_(resps).delete()
-                    .where(resps.id == Parameter('%s'))
-                    .get_sql(),
-                    (respid,)
+                    UPDATE_RESPONSE_BODY_SQL, ('I love to {foo}', respid)
+                )
+                itgs.write_conn.commit()
+                res: str = responses.get_response(itgs, 'my_response', foo='sing')
+                self.assertEqual(res, 'I like to sing')
+
+                responses.invalidate_response('my_response')
+                res: str = responses.get_response(itgs, 'my_response', foo='sing')
+                self.assertEqual(res, 'I love to sing')
+            finally:
+                itgs.write_conn.rollback()
+                itgs.write_cursor.execute(DELETE_RESPONSE_SQL, (respid,))
+                itgs.write_conn.commit()
+                responses.invalidate_response('my_response')
+
+    def test_letter(self):
+        with LazyIntegrations() as itgs:
+            itgs.write_cursor.execute(
+                INSERT_LETTER_SQL,
+                (
+                    'my_letter_title', 'Hello {name}', 'Testing desc',
+                    'my_letter_body', 'Goodbye {name}', 'Testing desc'
                 )
+            )
+            respids = [row[0] for row in itgs.write_cursor.fetchall()]
+            try:
+                itgs.write_conn.commit()
+                res = responses.get_letter_response(itgs, 'my_letter', name='Tj')
+                self.assertEqual(res, ('Hello Tj', 'Goodbye Tj'))
+            finally:
+                itgs.write_conn.rollback()
+                itgs.write_cursor.execute(DELETE_LETTER_SQL, respids)
                 itgs.write_conn.commit()
+                responses.invalidate_response('my_letter_title')
+                responses.invalidate_response('my_letter_body')
 
 
 if __name__ == '__main__':
@@ -1,8 +1,9 @@
 """Verifies that all the connections that can be created using the integrations
 module are able to service simple requests"""
 import unittest
+import os
 import sys
-import time
+from unittest import mock
 
 sys.path.append("../src")
 
@@ -10,13 +11,40 @@ import lbshared.retry_helper as retry_helper  # noqa: E402
 
 
 class TestIntegrations(unittest.TestCase):
+    def setUp(self):
+        self._remove_file()
+        self.addCleanup(self._remove_file)
+
+        # Rather than sleeping we record the delay and move this clock forward
+        self.now = 1000.0
+        self.sleeps = []
+        patchers = (
+            mock.patch.object(retry_helper, '_now', lambda: self.now),
+            mock.patch.object(retry_helper, '_sleep', self._sleep),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def _remove_file(self):
+        try:
+            os.remove(retry_helper.FILENAME)
+        except FileNotFoundError:
+            pass
+
     def test_handle(self):
-        now = time.time()
         retry_helper.handle(1)
-        self.assertLess(time.time(), now + 0.5)
-        now = time.time()
+        self.assertEqual(self.sleeps, [])
+        self.now += 0.25
+        retry_helper.handle(1)
+        self.assertEqual(self.sleeps, [0.75])
+        self.now += 2
         retry_helper.handle(1)
-        self.assertGreaterEqual(time.time(), now + 1)
+        self.assertEqual(self.sleeps, [0.75])
 
 
 if __name__ == '__main__':
@@ -10,6 +10,14 @@ sys.path.append("../src")
 import lbshared.signal_helper as signal_helper  # noqa: E402
 
 
+if hasattr(signal, 'raise_signal'):
+    # 3.8+
+    _raise = signal.raise_signal
+else:
+    def _raise(sig_num):
+        os.kill(os.getpid(), sig_num)
+
+
 class TestIntegrations(unittest.TestCase):
     def test_delay(self):
         saw_sigterm = False
@@ -22,14 +30,29 @@ class TestIntegrations(unittest.TestCase):
         try:
             with signal_helper.delay_signals():
                 self.assertFalse(saw_sigterm)
-                if hasattr(signal, 'raise_signal'):
-                    # 3.8+
-                    signal.raise_signal(signal.SIGTERM)
-                else:
-                    os.kill(os.getpid(), signal.SIGTERM)
+                _raise(signal.SIGTERM)
+
+                self.assertFalse(saw_sigterm)
+            self.assertTrue(saw_sigterm)
+        finally:
+            signal.signal(signal.SIGTERM, og_sigterm_handler)
+
+    def test_delay_nested(self):
+        saw_sigterm = False
+
+        def capture_sigterm(*args, **kwargs):
+            nonlocal saw_sigterm
+            saw_sigterm = True
+
+        og_sigterm_handler = signal.signal(signal.SIGTERM, capture_sigterm)
+        try:
+            with signal_helper.delay_signals():
+                with signal_helper.delay_signals():
+                    _raise(signal.SIGTERM)
 
                 self.assertFalse(saw_sigterm)
             self.assertTrue(saw_sigterm)
+            self.assertIs(signal.getsignal(signal.SIGTERM), capture_sigterm)
         finally:
             signal.signal(signal.SIGTERM, og_sigterm_handler)
 
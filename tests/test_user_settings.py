@@ -0,0 +1,150 @@
+"""Verifies that user settings can be read and changed, including under
+contention"""
+import unittest
+import sys
+import asyncio
+import secrets
+from unittest import mock
+from arango_crud.document import Document
+
+sys.path.append("../src")
+
+from lbshared.lazy_integrations import LazyIntegrations  # noqa: E402
+import lbshared.user_settings as user_settings  # noqa: E402
+
+
+class TestUserSettings(unittest.TestCase):
+    def setUp(self):
+        with LazyIntegrations() as itgs:
+            itgs.kvs_db.create_if_not_exists()
+            itgs.kvs_db.collection(
+                user_settings.USER_SETTINGS_COLLECTION
+            ).create_if_not_exists(ttl=None)
+
+        self.user_ids = []
+
+    def tearDown(self):
+        with LazyIntegrations() as itgs:
+            coll = itgs.kvs_db.collection(user_settings.USER_SETTINGS_COLLECTION)
+            for user_id in self.user_ids:
+                coll.force_delete_doc(str(user_id))
+
+    def new_user_id(self):
+        """Picks a user id which no other test is using"""
+        user_id = secrets.randbelow(2 ** 31)
+        self.user_ids.append(user_id)
+        return user_id
+
+    def test_get_defaults(self):
+        with LazyIntegrations() as itgs:
+            self.assertEqual(
+                user_settings.get_settings(itgs, self.new_user_id()),
+                user_settings.DEFAULTS[-1]
+            )
+
+    def test_set_and_aset_match(self):
+        sync_user_id = self.new_user_id()
+        async_user_id = self.new_user_id()
+        values = {'non_req_response_opt_out': True, 'ratelimit_max_tokens': 5}
+
+        with LazyIntegrations() as itgs:
+            sync_changes = user_settings.set_settings(itgs, sync_user_id, **values)
+            async_changes = asyncio.run(
+                user_settings.aset_settings(itgs, async_user_id, **values)
+            )
+            self.assertEqual(sync_changes, async_changes)
+            self.assertEqual(
+                sync_changes,
+                {
+                    'non_req_response_opt_out': {'old': False, 'new': True},
+                    'ratelimit_max_tokens': {'old': None, 'new': 5}
+                }
+            )
+
+            coll = itgs.kvs_db.collection(user_settings.USER_SETTINGS_COLLECTION)
+            self.assertEqual(
+                coll.read_doc(str(sync_user_id)),
+                coll.read_doc(str(async_user_id))
+            )
+
+            settings = user_settings.get_settings(itgs, sync_user_id)
+            self.assertEqual(settings, user_settings.get_settings(itgs, async_user_id))
+            self.assertTrue(settings.non_req_response_opt_out)
+            self.assertEqual(settings.ratelimit_max_tokens, 5)
+            self.assertFalse(settings.borrower_req_pm_opt_out)
+
+    def test_set_back_to_default(self):
+        user_id = self.new_user_id()
+        with LazyIntegrations() as itgs:
+            user_settings.set_settings(itgs, user_id, non_req_response_opt_out=True)
+            self.assertEqual(
+                user_settings.set_settings(itgs, user_id, non_req_response_opt_out=False),
+                {'non_req_response_opt_out': {'old': True, 'new': False}}
+            )
+
+            coll = itgs.kvs_db.collection(user_settings.USER_SETTINGS_COLLECTION)
+            self.assertNotIn('non_req_response_opt_out', coll.read_doc(str(user_id)))
+
+    def test_no_change_skips_write(self):
+        user_id = self.new_user_id()
+        with LazyIntegrations() as itgs:
+            user_settings.set_settings(itgs, user_id, non_req_response_opt_out=True)
+
+            doc = itgs.kvs_db.collection(
+                user_settings.USER_SETTINGS_COLLECTION
+            ).document(str(user_id))
+            self.assertTrue(doc.read())
+            etag = doc.etag
+
+            with mock.patch.object(Document, 'compare_and_swap') as cas:
+                self.assertEqual(
+                    user_settings.set_settings(
+                        itgs, user_id,
+                        non_req_response_opt_out=True, borrower_req_pm_opt_out=False
+                    ),
+                    {}
+                )
+                self.assertEqual(user_settings.set_settings(itgs, user_id), {})
+                cas.assert_not_called()
+
+            self.assertTrue(doc.read())
+            self.assertEqual(doc.etag, etag)
+
+    def test_conflict_retries(self):
+        user_id = self.new_user_id()
+        original_cas = Document.compare_and_swap
+        calls = []
+
+        with LazyIntegrations() as itgs:
+            coll = itgs.kvs_db.collection(user_settings.USER_SETTINGS_COLLECTION)
+            user_settings.get_settings(itgs, user_id)
+
+            def conflicting_cas(doc, *args, **kwargs):
+                calls.append(doc.key)
+                if len(calls) == 1:
+                    # Another writer gets in between our read and our write
+                    other = coll.document(doc.key)
+                    self.assertTrue(other.read())
+                    other.body['borrower_req_pm_opt_out'] = True
+                    self.assertTrue(original_cas(other))
+                return original_cas(doc, *args, **kwargs)
+
+            with mock.patch.object(
+                    Document, 'compare_and_swap',
+                    autospec=True, side_effect=conflicting_cas):
+                changes = user_settings.set_settings(
+                    itgs, user_id, non_req_response_opt_out=True
+                )
+
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(
+                changes, {'non_req_response_opt_out': {'old': False, 'new': True}}
+            )
+
+            settings = user_settings.get_settings(itgs, user_id)
+            self.assertTrue(settings.non_req_response_opt_out)
+            self.assertTrue(settings.borrower_req_pm_opt_out)
+
+
+if __name__ == '__main__':
+    unittest.main()